@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Synthetic dataset generator for benchmarking the CocMarket API at production scale.
+
+Creates users, products, reviews and price history with realistic skew (a few
+games hold most listings, power sellers own most products, popular listings
+collect most reviews) and writes them with batched, concurrent insert_many.
+
+Usage:
+    cd backend
+    python generate_dataset.py --users 200000 --products 10000000 --parallelism 16 --drop
+
+Uses the same MONGO_URL / DB_NAME settings as server.py.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List
+
+from server import (
+    client, db, ensure_indexes, game_counters, hash_password,
+    ProductCategory, ProductCondition, LocationRegion,
+)
+
+GAMES = [
+    "Fortnite", "Clash of Clans", "League of Legends", "CS:GO", "Valorant", "World of Warcraft",
+    "Genshin Impact", "Minecraft", "Roblox", "Apex Legends", "Call of Duty", "Rocket League",
+    "Clash Royale", "Brawl Stars", "FIFA", "Dota 2", "Overwatch", "Destiny 2", "Path of Exile",
+    "Lost Ark", "Diablo IV", "Pokémon GO", "Rainbow Six Siege", "PUBG", "Final Fantasy XIV",
+]
+TITLE_WORDS = {
+    ProductCategory.ACCOUNTS: ["Compte", "rare", "niveau", "skins exclusifs", "full accès", "OG"],
+    ProductCategory.ITEMS: ["Épée", "Armure", "légendaire", "enchantée", "+15", "mythique"],
+    ProductCategory.CHARACTERS: ["Personnage", "Paladin", "Mage", "niveau max", "équipé", "raid"],
+    ProductCategory.SKINS: ["Skin", "Factory New", "édition limitée", "collector", "StatTrak", "rare"],
+    ProductCategory.CURRENCY: ["Pack", "gemmes", "crédits", "livraison immédiate", "bonus", "V-Bucks"],
+    ProductCategory.BOOSTING: ["Boosting", "rang Diamond", "placement", "coaching", "rapide", "pro"],
+}
+# Median price per category, in euros
+CATEGORY_PRICES = {
+    ProductCategory.ACCOUNTS: 150, ProductCategory.ITEMS: 40, ProductCategory.CHARACTERS: 120,
+    ProductCategory.SKINS: 60, ProductCategory.CURRENCY: 25, ProductCategory.BOOSTING: 50,
+}
+
+
+def zipf_cum_weights(count: int, exponent: float) -> List[float]:
+    """Cumulative weights for random.choices giving rank r a weight of 1 / r**exponent"""
+    cumulative, total = [], 0.0
+    for rank in range(1, count + 1):
+        total += 1 / rank ** exponent
+        cumulative.append(total)
+    return cumulative
+
+
+class DatasetGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        # Ids are derived from a per-run prefix and the row number, so reviews and
+        # price history can reference products without keeping 10M ids in memory.
+        self.prefix = self.rng.getrandbits(80) << 48
+        self.password_hash = hash_password("Password123!")  # one hash shared by every generated user
+        self.now = datetime.utcnow()
+        self.game_weights = zipf_cum_weights(len(GAMES), 1.1)
+        self.seller_weights = zipf_cum_weights(args.users, 1.2)
+        self.product_weights = zipf_cum_weights(min(args.products, 1_000_000), 1.0)
+        self.categories = list(ProductCategory)
+        self.conditions = list(ProductCondition)
+        self.locations = list(LocationRegion)
+
+    def make_id(self, kind: int, index: int) -> str:
+        return str(uuid.UUID(int=self.prefix | (kind << 40) | index))
+
+    def user_id(self, index: int) -> str:
+        return self.make_id(1, index)
+
+    def product_id(self, index: int) -> str:
+        return self.make_id(2, index)
+
+    def random_product_index(self) -> int:
+        # Popular listings attract most activity; spread the ranks over the whole catalog
+        rank = self.rng.choices(range(len(self.product_weights)), cum_weights=self.product_weights)[0]
+        return (rank * 7919) % self.args.products
+
+    def users(self, start: int, stop: int) -> List[Dict[str, Any]]:
+        rng, batch = self.rng, []
+        for index in range(start, stop):
+            location = rng.choice(self.locations)
+            batch.append({
+                "id": self.user_id(index),
+                "username": f"player_{index}",
+                "email": f"player_{index}@example.com",
+                "password_hash": self.password_hash,
+                "location": location.value,
+                "avatar": None,
+                "trust_score": round(rng.uniform(3.5, 5.0), 1),
+                "total_sales": 0,
+                "total_purchases": 0,
+                "member_since": self.now - timedelta(days=rng.randint(0, 1500)),
+                "is_verified": rng.random() < 0.3,
+                "badges": [],
+                "display_name": f"Player {index}",
+                "bio": None,
+                "location_display": None,
+                "contact_info": {},
+                "seller_stats": {},
+                "is_online": False,
+                "last_seen": None,
+            })
+        return batch
+
+    def products(self, start: int, stop: int) -> List[Dict[str, Any]]:
+        rng, batch = self.rng, []
+        games = rng.choices(GAMES, cum_weights=self.game_weights, k=stop - start)
+        sellers = rng.choices(range(self.args.users), cum_weights=self.seller_weights, k=stop - start)
+        for offset, index in enumerate(range(start, stop)):
+            category = rng.choice(self.categories)
+            game_name = games[offset]
+            price = round(CATEGORY_PRICES[category] * rng.lognormvariate(0, 0.8), 2)
+            created_at = self.now - timedelta(seconds=rng.randint(0, 365 * 86400))
+            words = rng.sample(TITLE_WORDS[category], 3)
+            batch.append({
+                "id": self.product_id(index),
+                "title": f"{words[0]} {game_name} {words[1]} {words[2]}",
+                "description": f"{' '.join(rng.sample(TITLE_WORDS[category], 4))} pour {game_name}. Livraison sécurisée.",
+                "category": category.value,
+                "game_name": game_name,
+                "price": price,
+                "original_price": round(price * 1.25, 2) if rng.random() < 0.2 else None,
+                "condition": rng.choice(self.conditions).value,
+                "location": rng.choice(self.locations).value,
+                "seller_id": self.user_id(sellers[offset]),
+                "images": [],
+                "is_featured": rng.random() < 0.01,
+                "is_available": rng.random() < 0.85,
+                "level": rng.randint(1, 300) if category == ProductCategory.ACCOUNTS else None,
+                "rank": None,
+                "stats": {"level": rng.randint(1, 100), "rarity": rng.randint(1, 5)},
+                "created_at": created_at,
+                "updated_at": created_at,
+                "view_count": int(rng.paretovariate(1.5)) - 1,
+                "favorite_count": 0,
+                "version": 0,
+            })
+        return batch
+
+    def reviews(self, start: int, stop: int) -> List[Dict[str, Any]]:
+        rng, batch = self.rng, []
+        for _ in range(start, stop):
+            reviewer = rng.randrange(self.args.users)
+            batch.append({
+                "id": str(uuid.uuid4()),
+                "product_id": self.product_id(self.random_product_index()),
+                "reviewer_id": self.user_id(reviewer),
+                "reviewer_username": f"player_{reviewer}",
+                "rating": rng.choices([1, 2, 3, 4, 5], weights=[2, 3, 10, 35, 50])[0],
+                "comment": "Transaction rapide, conforme à la description.",
+                "created_at": self.now - timedelta(seconds=rng.randint(0, 365 * 86400)),
+                "is_verified_purchase": rng.random() < 0.8,
+            })
+        return batch
+
+    def price_history(self, start: int, stop: int) -> List[Dict[str, Any]]:
+        rng, batch = self.rng, []
+        for _ in range(start, stop):
+            batch.append({
+                "id": str(uuid.uuid4()),
+                "product_id": self.product_id(self.random_product_index()),
+                "price": round(rng.lognormvariate(4, 0.8), 2),
+                "timestamp": self.now - timedelta(seconds=rng.randint(0, 365 * 86400)),
+            })
+        return batch
+
+
+def batches(total: int, batch_size: int, build: Callable[[int, int], List[Dict[str, Any]]]) -> Iterator[List[Dict[str, Any]]]:
+    for start in range(0, total, batch_size):
+        yield build(start, min(total, start + batch_size))
+
+
+async def write_batches(collection: str, total: int, batch_size: int, parallelism: int,
+                        build: Callable[[int, int], List[Dict[str, Any]]]):
+    """Insert `total` generated documents with at most `parallelism` insert_many calls in flight"""
+    if total <= 0:
+        return
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(parallelism)
+    pending = set()
+    failures: List[BaseException] = []
+    written = 0
+
+    async def insert(batch):
+        nonlocal written
+        try:
+            await db[collection].insert_many(batch, ordered=False)
+            written += len(batch)
+        except Exception as e:
+            # Finished tasks leave `pending`, so their errors are kept here
+            failures.append(e)
+        finally:
+            semaphore.release()
+
+    for number, batch in enumerate(batches(total, batch_size, build), start=1):
+        # Generation waits for a free writer so memory stays bounded to `parallelism` batches
+        await semaphore.acquire()
+        if failures:
+            break
+        task = asyncio.create_task(insert(batch))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        if number % 100 == 0:
+            rate = written / (time.perf_counter() - started)
+            print(f"   {collection}: {written}/{total} ({rate:,.0f} docs/s)")
+    await asyncio.gather(*pending)
+    if failures:
+        raise RuntimeError(f"{collection}: {len(failures)} batch(es) failed, {written}/{total} documents written") from failures[0]
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ {collection}: {written} documents in {elapsed:.1f}s ({written / elapsed:,.0f} docs/s)")
+
+
+async def generate(args):
+    generator = DatasetGenerator(args)
+
+    if args.drop:
+        for collection in ["users", "products", "reviews", "price_history", "game_counters"]:
+            await db[collection].drop()
+        print("🧹 Existing collections dropped")
+
+    review_count = int(args.products * args.reviews_per_product)
+    history_count = int(args.products * args.price_history_per_product)
+    await write_batches("users", args.users, args.batch_size, args.parallelism, generator.users)
+    await write_batches("products", args.products, args.batch_size, args.parallelism, generator.products)
+    await write_batches("reviews", review_count, args.batch_size, args.parallelism, generator.reviews)
+    await write_batches("price_history", history_count, args.batch_size, args.parallelism, generator.price_history)
+
+    # Indexes are cheaper to build once the data is in place
+    print("🗂️  Building indexes and game counters")
+    await ensure_indexes()
+    await game_counters.reconcile()
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic CocMarket dataset")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--reviews-per-product", type=float, default=0.5)
+    parser.add_argument("--price-history-per-product", type=float, default=2.0)
+    parser.add_argument("--batch-size", type=int, default=2_000)
+    parser.add_argument("--parallelism", type=int, default=8, help="concurrent insert_many calls")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--drop", action="store_true", help="drop the generated collections first")
+    args = parser.parse_args()
+    if args.users < 1 or args.products < 1:
+        parser.error("--users and --products must be positive")
+
+    asyncio.run(generate(args))
+
+
+if __name__ == "__main__":
+    main()
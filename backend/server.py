@@ -1,17 +1,36 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query, Depends, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Depends, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+import pymongo
+from pymongo import ReturnDocument, UpdateOne, DeleteMany, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 import os
+import abc
 import logging
 from pathlib import Path
 import asyncio
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Awaitable, Union, Tuple
 import uuid
+import time
+import math
+import re
+import unicodedata
+import bisect
+import heapq
+import itertools
+import threading
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from urllib.parse import urlparse
 from enum import Enum
 import hashlib
+import json
 import secrets
 import stripe
 import aiohttp
@@ -21,6 +40,7 @@ from google.oauth2 import id_token
 from google.auth.transport import requests
 from authlib.integrations.starlette_client import OAuth
 from authlib.jose import jwt
+import numpy as np
 import uvicorn
 
 
@@ -57,14 +77,158 @@ except Exception as e:
     # Firebase not configured; continue without it
     db_firebase = None
 
+# MongoDB command monitoring
+# Commands worth timing per collection; everything else (handshakes, pings, explain) is ignored
+MONITORED_COMMANDS = {
+    "find": "filter", "aggregate": "pipeline", "count": "query", "distinct": "query",
+    "findAndModify": "query", "insert": None, "update": "updates", "delete": "deletes",
+}
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct"}
+# Driver fields that must not be replayed inside an explain command
+DRIVER_COMMAND_FIELDS = {"lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "signature"}
+
+def redact_shape(value: Any) -> Any:
+    """Keep the keys and operators of a filter or pipeline, replacing every value by a placeholder"""
+    if isinstance(value, dict):
+        return {key: redact_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = [redact_shape(item) for item in value]
+        return shapes if any(isinstance(item, (dict, list)) for item in shapes) else "?"
+    return "?"
+
+def summarize_plan(explain_result: Dict[str, Any]) -> str:
+    """Reduce an explain result to its winning stages and index names, e.g. FETCH > IXSCAN(price_1)"""
+    def find_plan(node):
+        if isinstance(node, dict):
+            if "winningPlan" in node:
+                return node["winningPlan"]
+            children = node.values()
+        elif isinstance(node, list):
+            children = node
+        else:
+            return None
+        for child in children:
+            plan = find_plan(child)
+            if plan is not None:
+                return plan
+        return None
+    
+    stages = []
+    node = find_plan(explain_result)
+    while isinstance(node, dict):
+        stage = node.get("stage", "?")
+        stages.append(f"{stage}({node['indexName']})" if "indexName" in node else stage)
+        node = node.get("inputStage") or (node.get("inputStages") or [None])[0] or node.get("queryPlan")
+    return " > ".join(stages) if stages else "unknown"
+
+class MongoCommandMonitor(monitoring.CommandListener):
+    """Time driver commands per collection/operation, log slow ones and explain the slowest shapes.
+
+    Listener callbacks run on the driver's worker threads, so explains are handed
+    back to the event loop with call_soon_threadsafe.
+    """
+
+    def __init__(self, slow_ms: float, max_explained_shapes: int = 50):
+        self.slow_ms = slow_ms
+        self.max_explained_shapes = max_explained_shapes
+        self.slow_shapes: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._inflight: Dict[Tuple, Tuple[str, str, Dict[str, Any]]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def attach(self):
+        self._loop = asyncio.get_running_loop()
+
+    def started(self, event):
+        if event.command_name not in MONITORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = "(database)"
+        self._inflight[(event.connection_id, event.request_id)] = (collection, event.database_name, event.command)
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+    def _finish(self, event, outcome: str):
+        started = self._inflight.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        collection, database_name, command = started
+        duration = event.duration_micros / 1_000_000
+        labels = (("collection", collection), ("command", event.command_name))
+        metrics.observe("mongo_command_duration_seconds", labels, duration)
+        if outcome == "error":
+            metrics.inc("mongo_command_failures_total", labels)
+        if duration * 1000 >= self.slow_ms:
+            self._record_slow(event.command_name, collection, database_name, command, duration)
+
+    def _record_slow(self, command_name: str, collection: str, database_name: str, command: Dict[str, Any], duration: float):
+        shape_field = MONITORED_COMMANDS[command_name]
+        shape = json.dumps(redact_shape(command.get(shape_field)) if shape_field else None, sort_keys=True, default=str)
+        key = f"{collection}.{command_name} {shape}"
+        logger.warning(f"🐢 Requête Mongo lente ({duration * 1000:.0f} ms): {key}")
+        with self._lock:
+            self._track_slow_shape(key, command_name, database_name, command, duration)
+
+    def _track_slow_shape(self, key: str, command_name: str, database_name: str, command: Dict[str, Any], duration: float):
+        entry = self.slow_shapes.get(key)
+        if entry is None:
+            if len(self.slow_shapes) >= self.max_explained_shapes:
+                # Keep only the slowest shapes: make room unless this one is faster than all of them
+                fastest_key = min(self.slow_shapes, key=lambda k: self.slow_shapes[k]["max_ms"])
+                if self.slow_shapes[fastest_key]["max_ms"] >= duration * 1000:
+                    return
+                del self.slow_shapes[fastest_key]
+            entry = self.slow_shapes[key] = {"count": 0, "max_ms": 0.0, "plan": None}
+            if command_name in EXPLAINABLE_COMMANDS and self._loop is not None:
+                explained = {k: v for k, v in command.items() if k not in DRIVER_COMMAND_FIELDS}
+                # spawn_background keeps a reference to the task until it is done
+                self._loop.call_soon_threadsafe(
+                    lambda: spawn_background(self._explain(key, database_name, explained))
+                )
+        entry["count"] += 1
+        entry["max_ms"] = max(entry["max_ms"], round(duration * 1000, 1))
+
+    async def _explain(self, key: str, database_name: str, command: Dict[str, Any]):
+        try:
+            result = await client[database_name].command({"explain": command, "verbosity": "queryPlanner"})
+        except Exception as e:
+            logger.error(f"❌ Explain impossible pour {key}: {e}")
+            return
+        plan = summarize_plan(result)
+        with self._lock:
+            if key in self.slow_shapes:
+                self.slow_shapes[key]["plan"] = plan
+        logger.warning(f"🔍 Plan de {key}: {plan}")
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            shapes = [{"shape": key, **entry} for key, entry in self.slow_shapes.items()]
+        return sorted(shapes, key=lambda entry: entry["max_ms"], reverse=True)
+
+mongo_monitor = MongoCommandMonitor(slow_ms=float(os.environ.get('MONGO_SLOW_QUERY_MS', '100')))
+
 # MongoDB connection (with safe defaults for local dev)
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 db_name = os.environ.get('DB_NAME', 'cocmarket')
+# Pool sizing and timeouts come from the environment so production can tune them per deployment
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
 client = AsyncIOMotorClient(
     mongo_url,
-    serverSelectionTimeoutMS=2000,
-    connectTimeoutMS=2000,
-    socketTimeoutMS=2000,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000')),
+    serverSelectionTimeoutMS=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '2000')),
+    connectTimeoutMS=int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '2000')),
+    # Per-request deadlines bound each operation (see ROUTE_DEADLINES); a socket timeout would
+    # also cut legitimately slow background work, so there is none unless configured
+    socketTimeoutMS=int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '0')) or None,
+    event_listeners=[mongo_monitor],
 )
 db = client[db_name]
 
@@ -103,6 +267,117 @@ def generate_session_token() -> str:
     """Generate a secure session token"""
     return secrets.token_urlsafe(32)
 
+# Rate limiting and load shedding for the password-hashing endpoints
+class TokenBucketLimiter:
+    """In-process token buckets: each key may spend `capacity` requests, refilled over `period` seconds"""
+
+    def __init__(self, capacity: float, period: float, max_keys: int = 100000):
+        self.capacity = capacity
+        self.refill_rate = capacity / period
+        self.max_keys = max_keys
+        self._buckets: Dict[str, List[float]] = {}
+
+    def acquire(self, key: str) -> float:
+        """Spend one token for `key`; returns 0 when allowed, otherwise seconds until a token is available"""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._evict_full(now)
+            bucket = self._buckets[key] = [self.capacity, now]
+        tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill_rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return (1 - tokens) / self.refill_rate
+        bucket[0] = tokens - 1
+        return 0.0
+
+    def _evict_full(self, now: float):
+        # A bucket that has refilled completely holds no state worth keeping
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * self.refill_rate >= self.capacity:
+                del self._buckets[key]
+        if len(self._buckets) >= self.max_keys:
+            self._buckets.clear()
+
+def parse_rate_limit(value: str) -> TokenBucketLimiter:
+    """Build a limiter from a `<requests>/<seconds>` budget, e.g. `10/60`"""
+    requests_count, period = value.split("/")
+    return TokenBucketLimiter(float(requests_count), float(period))
+
+# Per-route budgets, keyed by client IP and by account email
+RATE_LIMITERS = {
+    "login": {
+        "ip": parse_rate_limit(os.environ.get('RATE_LIMIT_LOGIN_IP', '20/60')),
+        "email": parse_rate_limit(os.environ.get('RATE_LIMIT_LOGIN_EMAIL', '5/60')),
+    },
+    "register": {
+        "ip": parse_rate_limit(os.environ.get('RATE_LIMIT_REGISTER_IP', '5/60')),
+        "email": parse_rate_limit(os.environ.get('RATE_LIMIT_REGISTER_EMAIL', '3/3600')),
+    },
+}
+TRUST_FORWARDED_FOR = os.environ.get('TRUST_FORWARDED_FOR', '').lower() in ('1', 'true', 'yes')
+
+def client_ip(request: Request) -> str:
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def enforce_rate_limit(route: str, request: Request, email: str):
+    """Reject with 429 before any password hashing when the IP or account budget is spent"""
+    limiters = RATE_LIMITERS[route]
+    # A rejected IP must not drain the account's budget, or one client could lock any account out
+    retry_after = limiters["ip"].acquire(client_ip(request))
+    if not retry_after:
+        retry_after = limiters["email"].acquire(email.strip().lower())
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many attempts, please retry later",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+class HashingGate:
+    """Bound concurrent password hashing and shed load once the queue gets too slow.
+
+    Hashing runs in worker threads (PBKDF2 releases the GIL) so the event loop keeps
+    serving other routes. Requests that cannot start hashing within `max_queue_wait`
+    seconds, or that find `max_queue` requests already waiting, get a 503.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, max_queue_wait: float):
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+
+    def _busy(self):
+        return HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+
+    async def run(self, fn: Callable[..., Any], *args):
+        if self._waiting >= self.max_queue:
+            raise self._busy()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_queue_wait)
+        except asyncio.TimeoutError:
+            raise self._busy()
+        finally:
+            self._waiting -= 1
+        try:
+            return await asyncio.to_thread(fn, *args)
+        finally:
+            self._semaphore.release()
+
+password_hashing_gate = HashingGate(
+    max_concurrency=int(os.environ.get('PASSWORD_HASH_CONCURRENCY', str(os.cpu_count() or 1))),
+    max_queue=int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', '64')),
+    max_queue_wait=float(os.environ.get('PASSWORD_HASH_MAX_QUEUE_WAIT', '0.5')),
+)
+
 # Create the main app without a prefix
 app = FastAPI(title="CocMarket Gaming Marketplace API")
 
@@ -121,8 +396,201 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Metrics
+# Default latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class MetricsRegistry:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Updates take a lock because some of them come from driver threads.
+    Labels are passed as tuples of (name, value) pairs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metadata: Dict[str, Tuple[str, str]] = {}
+        self._values: Dict[str, Dict[Tuple, float]] = {}
+        self._histograms: Dict[str, Dict[Tuple, List[float]]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+
+    def declare(self, name: str, kind: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self._metadata[name] = (kind, help_text)
+        if kind == "histogram":
+            self._histograms[name] = {}
+            self._buckets[name] = buckets
+        else:
+            self._values[name] = {}
+
+    def inc(self, name: str, labels: Tuple = (), value: float = 1.0):
+        with self._lock:
+            series = self._values[name]
+            series[labels] = series.get(labels, 0.0) + value
+
+    def set(self, name: str, labels: Tuple = (), value: float = 0.0):
+        with self._lock:
+            self._values[name][labels] = value
+
+    def observe(self, name: str, labels: Tuple, value: float):
+        buckets = self._buckets[name]
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            series = self._histograms[name].get(labels)
+            if series is None:
+                # Per-bucket counts (plus +Inf), then sum and count
+                series = self._histograms[name][labels] = [0.0] * (len(buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @staticmethod
+    def _format_labels(labels: Tuple) -> str:
+        if not labels:
+            return ""
+        escaped = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self._metadata.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind != "histogram":
+                    for labels, value in self._values[name].items():
+                        lines.append(f"{name}{self._format_labels(labels)} {value}")
+                    continue
+                buckets = self._buckets[name]
+                for labels, series in self._histograms[name].items():
+                    cumulative = 0.0
+                    for bound, count in zip(buckets + (float("inf"),), series):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{self._format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {series[-2]}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {series[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.declare("http_request_duration_seconds", "histogram", "Request latency per route template")
+metrics.declare("http_requests_total", "counter", "Requests per route template and status code")
+metrics.declare("http_requests_in_flight", "gauge", "Requests currently being handled per route template")
+metrics.declare("mongo_command_duration_seconds", "histogram", "MongoDB command latency per collection and command")
+metrics.declare("mongo_command_failures_total", "counter", "Failed MongoDB commands per collection and command")
+
+# Request deadlines
+# Time budget per route template, in seconds. It is pushed down to MongoDB as maxTimeMS on every
+# operation through pymongo's client-side operation timeout; None leaves a route unbounded.
+DEFAULT_REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE_SECONDS', '5'))
+ROUTE_DEADLINES: Dict[str, Optional[float]] = {
+    "/api/health": 2.0,
+    "/api/products": 2.0,
+    "/api/products/{product_id}": 1.0,
+    "/api/sellers/{user_id}/products": 2.0,
+    "/api/market-stats": 5.0,
+    "/api/webhook/stripe": 15.0,
+    # Streams and bulk admin jobs run for as long as they need
+    "/api/feed/products": None,
+    "/api/init-sample-data": None,
+}
+
+class CancelOnDisconnectMiddleware:
+    """Cancel a read's handler when the client disconnects before the response is complete.
+
+    The request messages are read by a watcher task and handed to the app through a
+    queue, so the watcher sees the disconnect even while the handler is busy. MongoDB
+    stops an abandoned operation at its maxTimeMS at the latest. Writes always run to
+    completion: cancelling one between its Mongo write and its change hooks would
+    leave counters and indexes out of step.
+    """
+
+    CANCELLABLE_METHODS = {"GET", "HEAD"}
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in self.CANCELLABLE_METHODS:
+            await self.app(scope, receive, send)
+            return
+        messages: asyncio.Queue = asyncio.Queue()
+        response_complete = False
+
+        async def tracked_send(message):
+            nonlocal response_complete
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        handler = asyncio.ensure_future(self.app(scope, messages.get, tracked_send))
+
+        async def watch():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    if not response_complete:
+                        metrics.inc("http_requests_cancelled_total")
+                        handler.cancel()
+                    return
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not handler.cancelled():
+                raise
+        finally:
+            watcher.cancel()
+
+metrics.declare("http_requests_cancelled_total", "counter", "Requests cancelled because the client disconnected")
+
+class TimedRoute(APIRoute):
+    """API route recording latency, status codes and in-flight requests under its path template.
+
+    Handlers run under their route's deadline (ROUTE_DEADLINES); database timeouts become 504s.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route_labels = (("method", ",".join(sorted(self.methods))), ("route", self.path))
+        deadline = ROUTE_DEADLINES.get(self.path, DEFAULT_REQUEST_DEADLINE)
+
+        async def timed_handler(request: Request) -> Response:
+            status_code = 500
+            metrics.inc("http_requests_in_flight", route_labels)
+            start = time.perf_counter()
+            try:
+                with pymongo.timeout(deadline):
+                    response = await handler(request)
+                status_code = response.status_code
+                return response
+            except HTTPException as e:
+                status_code = e.status_code
+                raise
+            except RequestValidationError:
+                status_code = 422
+                raise
+            except PyMongoError as e:
+                if not e.timeout:
+                    raise
+                status_code = 504
+                raise HTTPException(status_code=504, detail="Request deadline exceeded") from e
+            except asyncio.CancelledError:
+                status_code = 499  # client closed the request
+                raise
+            finally:
+                metrics.observe("http_request_duration_seconds", route_labels, time.perf_counter() - start)
+                metrics.inc("http_requests_total", route_labels + (("status", str(status_code)),))
+                metrics.inc("http_requests_in_flight", route_labels, -1)
+
+        return timed_handler
+
 # Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+api_router = APIRouter(prefix="/api", route_class=TimedRoute)
 
 # Health endpoint to quickly verify configuration at runtime
 @api_router.get("/health")
@@ -144,6 +612,16 @@ async def health():
         }
     }
 
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Expose collected metrics in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@api_router.get("/metrics/slow-queries")
+async def get_slow_queries():
+    """Slowest MongoDB command shapes (values redacted) with their captured plans"""
+    return mongo_monitor.snapshot()
+
 # Enums
 class ProductCategory(str, Enum):
     ACCOUNTS = "accounts"
@@ -188,6 +666,17 @@ class GameProduct(BaseModel):
     updated_at: datetime = Field(default_factory=datetime.utcnow)
     view_count: int = 0
     favorite_count: int = 0
+    version: int = 0  # Incremented on every update; documents without it are at version 0
+
+class SimilarListing(BaseModel):
+    id: str
+    title: str
+    game_name: str
+    category: ProductCategory
+    price: float
+    location: LocationRegion
+    condition: ProductCondition = ProductCondition.EXCELLENT
+    score: float
 
 class GameProductCreate(BaseModel):
     title: str
@@ -211,6 +700,8 @@ class GameProductUpdate(BaseModel):
     condition: Optional[ProductCondition] = None
     is_available: Optional[bool] = None
     stats: Optional[Dict[str, Any]] = None
+    # When set, the update only applies if the product is still at this version (409 otherwise)
+    expected_version: Optional[int] = None
 
 # User Models
 class User(BaseModel):
@@ -235,117 +726,2156 @@ class User(BaseModel):
     is_online: bool = False
     last_seen: Optional[datetime] = None
 
-class UserCreate(BaseModel):
-    username: str
-    email: str
-    password: str  # Added password field
-    location: LocationRegion = LocationRegion.FR
-    avatar: Optional[str] = None
-    display_name: Optional[str] = None
-    bio: Optional[str] = None
-    location_display: Optional[str] = None
+class UserCreate(BaseModel):
+    username: str
+    email: str
+    password: str  # Added password field
+    location: LocationRegion = LocationRegion.FR
+    avatar: Optional[str] = None
+    display_name: Optional[str] = None
+    bio: Optional[str] = None
+    location_display: Optional[str] = None
+
+class UserLogin(BaseModel):
+    email: str
+    password: str
+
+class UserUpdate(BaseModel):
+    username: Optional[str] = None
+    email: Optional[str] = None
+    display_name: Optional[str] = None
+    bio: Optional[str] = None
+    location_display: Optional[str] = None
+    avatar: Optional[str] = None
+    location: Optional[LocationRegion] = None
+
+# Session Models
+class UserSession(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    token: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime
+    is_active: bool = True
+
+class AuthResponse(BaseModel):
+    user: User
+    token: str
+    expires_at: datetime
+
+async def get_current_user(token: str = None) -> User:
+    """Get current user from session token"""
+    if not token:
+        raise HTTPException(status_code=401, detail="No token provided")
+    
+    # Find active session
+    session = await db.sessions.find_one({
+        "token": token, 
+        "is_active": True,
+        "expires_at": {"$gt": datetime.utcnow()}
+    })
+    
+    if not session:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    
+    # Get user
+    user = await db.users.find_one({"id": session["user_id"]})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    return User(**user)
+
+# Review Models
+class Review(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    product_id: str
+    reviewer_id: str
+    reviewer_username: str
+    rating: int  # 1-5 stars
+    comment: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    is_verified_purchase: bool = False
+
+class ReviewCreate(BaseModel):
+    product_id: str
+    reviewer_id: str
+    reviewer_username: str
+    rating: int
+    comment: str
+    is_verified_purchase: bool = False
+
+# Favorite Models
+class Favorite(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    product_id: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Market Data Models
+class PriceHistory(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    product_id: str
+    price: float
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class MarketStats(BaseModel):
+    total_products: int
+    total_sales: int
+    average_price: float
+    trending_games: List[str]
+    featured_products: List[GameProduct]
+
+class FacetCount(BaseModel):
+    value: str
+    count: int
+
+class PriceBucketCount(BaseModel):
+    min: float
+    max: Optional[float] = None  # None for the open-ended top bucket
+    count: int
+
+class ProductFacets(BaseModel):
+    category: List[FacetCount]
+    location: List[FacetCount]
+    condition: List[FacetCount]
+    price: List[PriceBucketCount]
+
+class ProductPage(BaseModel):
+    products: List[GameProduct]
+    facets: ProductFacets
+
+class AutocompleteSuggestion(BaseModel):
+    text: str
+    kind: str  # "game" or "term"
+    count: int  # Available listings matching the suggestion
+
+class PriceGroupStats(BaseModel):
+    game_name: str
+    category: ProductCategory
+    condition: ProductCondition
+    sample_size: int
+    min: float
+    p5: float
+    p25: float
+    median: float
+    p75: float
+    p95: float
+    max: float
+    mad: float  # Median absolute deviation from the median price
+    updated_at: datetime
+
+class PriceInsight(BaseModel):
+    product_id: str
+    price: float
+    group: Optional[PriceGroupStats] = None
+    percentile_rank: Optional[float] = None  # Share of comparable listings priced lower, in %
+    robust_z: Optional[float] = None
+    verdict: str  # "low", "fair", "high" or "insufficient_data"
+    is_outlier: bool = False
+
+# Models pour l'authentification sociale
+class SocialAuthRequest(BaseModel):
+    token: str
+    provider: str  # "google" ou "apple"
+
+# Legacy models for compatibility
+class StatusCheck(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    client_name: str
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class StatusCheckCreate(BaseModel):
+    client_name: str
+
+# Stripe Payment Models
+class PaymentRequest(BaseModel):
+    product_id: str
+    success_url: str
+    cancel_url: str
+    token: Optional[str] = None  # Session token of the buyer, when logged in
+
+# Order Models
+class Order(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    stripe_session_id: str  # Unique: Stripe may deliver the same event several times
+    product_id: str
+    seller_id: str
+    buyer_id: Optional[str] = None
+    game_name: str
+    category: str
+    amount: float
+    currency: str = "eur"
+    # Side effects of the sale, set once done so a redelivered event resumes whatever is missing
+    product_marked_sold: bool = False
+    sale_recorded: bool = False
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Saved Search Models
+class SavedSearchCreate(BaseModel):
+    name: Optional[str] = None
+    category: Optional[ProductCategory] = None
+    game_name: Optional[str] = None
+    location: Optional[LocationRegion] = None
+    min_price: Optional[float] = Field(None, ge=0)
+    max_price: Optional[float] = Field(None, ge=0)
+
+class SavedSearch(SavedSearchCreate):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class Notification(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    kind: str  # "new_listing" or "price_drop"
+    saved_search_id: str
+    product_id: str
+    title: str
+    price: float
+    previous_price: Optional[float] = None
+    read: bool = False
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Background writers
+class BufferedWriter:
+    """Buffer documents in memory and write them with insert_many from a background task.
+
+    Callers only append to the buffer, so no database round trip is added to the
+    request path. The buffer is flushed every `flush_interval` seconds, or as soon as
+    `max_batch` documents are pending.
+    """
+
+    def __init__(self, collection: str, flush_interval: float = 2.0, max_batch: int = 500, max_pending: int = 50000):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._buffer: List[Dict[str, Any]] = []
+        self._wakeup = asyncio.Event()
+
+    def add(self, document: Dict[str, Any]):
+        self._buffer.append(document)
+        if len(self._buffer) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        while self._buffer:
+            batch = self._buffer[:self.max_batch]
+            self._buffer = self._buffer[self.max_batch:]
+            try:
+                await db[self.collection].insert_many(batch, ordered=False)
+            except Exception as e:
+                logger.error(f"❌ Erreur d'écriture groupée dans {self.collection}: {e}")
+                # Keep the batch for the next flush, but never grow without bound while Mongo is down
+                self._buffer = (batch + self._buffer)[-self.max_pending:]
+                return
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+price_history_writer = BufferedWriter(
+    "price_history",
+    flush_interval=float(os.environ.get('PRICE_HISTORY_FLUSH_SECONDS', '2')),
+)
+
+# Hooks awaited at boot, long-running coroutines started with the app, and flushes awaited on shutdown
+startup_hooks: List[Callable[[], Awaitable[None]]] = []
+background_jobs: List[Callable[[], Awaitable[None]]] = [price_history_writer.run]
+shutdown_flushes: List[Callable[[], Awaitable[None]]] = [price_history_writer.flush]
+background_tasks: List[asyncio.Task] = []
+
+# Strong references so spawned tasks are not garbage collected mid-flight
+pending_background_work: set = set()
+
+async def without_deadline(coro: Awaitable[Any]) -> Any:
+    # Tasks copy the spawning request's context, deadline included
+    with pymongo.timeout(None):
+        return await coro
+
+def spawn_background(coro: Awaitable[None]):
+    """Run a fire-and-forget coroutine off the request path, logging its failure"""
+    task = asyncio.ensure_future(without_deadline(coro))
+    pending_background_work.add(task)
+
+    def done(finished: asyncio.Future):
+        pending_background_work.discard(finished)
+        if not finished.cancelled() and finished.exception():
+            logger.error(f"❌ Erreur en tâche de fond: {finished.exception()}")
+    task.add_done_callback(done)
+
+def every(seconds: float, job: Callable[[], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+    """Wrap `job` into a background loop running it every `seconds`"""
+    async def loop():
+        while True:
+            await asyncio.sleep(seconds)
+            try:
+                await job()
+            except Exception as e:
+                logger.error(f"❌ Erreur dans la tâche périodique {job.__name__}: {e}")
+    return loop
+
+class TTLCache:
+    """Bounded in-process cache whose entries expire after `ttl` seconds (LRU eviction)"""
+
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+class SingleFlight:
+    """Coalesce concurrent identical calls: the first caller runs `compute`, the others await its result.
+
+    The shared computation is shielded, so a caller that disconnects does not cancel
+    it for the others. Results are shared between callers and must not be mutated.
+    """
+
+    def __init__(self, route: str):
+        self.route = route
+        self._calls: Dict[Any, asyncio.Future] = {}
+
+    async def do(self, key: Any, compute: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            metrics.inc("singleflight_calls_total", (("route", self.route), ("outcome", "executed")))
+            call = self._calls[key] = asyncio.ensure_future(compute())
+            call.add_done_callback(lambda finished: self._finish(key, finished))
+        else:
+            metrics.inc("singleflight_calls_total", (("route", self.route), ("outcome", "coalesced")))
+        return await asyncio.shield(call)
+
+    def _finish(self, key: Any, finished: asyncio.Future):
+        if self._calls.get(key) is finished:
+            del self._calls[key]
+        if not finished.cancelled():
+            finished.exception()  # retrieved here in case every caller went away
+
+metrics.declare("singleflight_calls_total", "counter", "Read computations per route, executed or coalesced into one in flight")
+
+# Cache backends and invalidation bus
+class CacheBackend(abc.ABC):
+    """Async key/value store with a per-call time to live.
+
+    Values must be JSON serializable; shared backends return them in their JSON form
+    (datetimes as ISO strings), which the pydantic models parse back.
+    """
+
+    @abc.abstractmethod
+    async def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        ...
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: Any, ttl: float):
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, keys: List[str]):
+        ...
+
+class InProcessCache(CacheBackend):
+    """Cache private to this worker"""
+
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.entries = TTLCache(ttl=ttl, max_entries=max_entries)
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        found = {}
+        for key in keys:
+            value = self.entries.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    async def set(self, key: str, value: Any, ttl: float):
+        self.entries.set(key, value)
+
+    async def delete(self, keys: List[str]):
+        for key in keys:
+            self.entries.delete(key)
+
+class RedisConnection:
+    """One connection speaking the Redis protocol (RESP2), enough for GET/SET/DEL/PUBLISH/SUBSCRIBE"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, url: str, timeout: float = 2.0) -> "RedisConnection":
+        parsed = urlparse(url)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parsed.hostname or "localhost", parsed.port or 6379), timeout
+        )
+        connection = cls(reader, writer)
+        if parsed.password:
+            await connection.command("AUTH", *([parsed.username] if parsed.username else []), parsed.password)
+        database = parsed.path.strip("/")
+        if database and database != "0":
+            await connection.command("SELECT", database)
+        return connection
+
+    def send(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self.writer.write(b"".join(parts))
+
+    async def read_reply(self) -> Any:
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {body.decode()}")
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(body)
+            return None if length < 0 else [await self.read_reply() for _ in range(length)]
+        raise ConnectionError(f"Unexpected Redis reply: {line!r}")
+
+    async def command(self, *args) -> Any:
+        self.send(*args)
+        await self.writer.drain()
+        return await self.read_reply()
+
+    def close(self):
+        self.writer.close()
+
+class RedisCache(CacheBackend):
+    """Cache shared by all workers, stored in a Redis-protocol server.
+
+    Failures are logged and treated as misses: the cache must never take the API down.
+    """
+
+    def __init__(self, url: str, pool_size: int = 8, timeout: float = 0.5):
+        self.url = url
+        self.timeout = timeout
+        self._idle: List[RedisConnection] = []
+        self._slots = asyncio.Semaphore(pool_size)
+
+    async def command(self, *args) -> Any:
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await RedisConnection.open(self.url, self.timeout)
+            try:
+                reply = await asyncio.wait_for(connection.command(*args), self.timeout)
+            except BaseException:
+                # The reply may still be in flight: never hand this connection out again
+                connection.close()
+                raise
+            self._idle.append(connection)
+            return reply
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        if not keys:
+            return {}
+        try:
+            values = await self.command("MGET", *keys)
+        except Exception as e:
+            logger.warning(f"⚠️ Cache partagé indisponible (lecture): {e}")
+            return {}
+        return {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    async def set(self, key: str, value: Any, ttl: float):
+        try:
+            await self.command("SET", key, json.dumps(jsonable_encoder(value)), "PX", int(ttl * 1000))
+        except Exception as e:
+            logger.warning(f"⚠️ Cache partagé indisponible (écriture): {e}")
+
+    async def delete(self, keys: List[str]):
+        if keys:
+            try:
+                await self.command("DEL", *keys)
+            except Exception as e:
+                logger.warning(f"⚠️ Cache partagé indisponible (suppression): {e}")
+
+class InvalidationBus:
+    """Tells the other workers to drop entries from their in-process caches.
+
+    Without REDIS_URL there is nobody to tell (single worker), so publishing is a
+    no-op. With it, messages go through Redis pub/sub and each worker ignores its
+    own messages, which it already applied locally. The same channel relays other
+    per-worker events by topic (`relay` / `on_event`).
+    """
+
+    CHANNEL = "cocmarket:invalidate"
+
+    def __init__(self, url: Optional[str]):
+        self.url = url
+        self.origin = secrets.token_hex(8)
+        self.namespaces: Dict[str, "CacheNamespace"] = {}
+        self.handlers: Dict[str, List[Callable[[Any], None]]] = {}
+        # Called when the subscription drops, since relayed events may have been missed
+        self.disconnect_listeners: List[Callable[[], None]] = []
+        self._publisher: Optional[RedisCache] = RedisCache(url) if url else None
+
+    def register(self, namespace: "CacheNamespace"):
+        self.namespaces[namespace.name] = namespace
+
+    async def publish(self, namespace: str, keys: List[str]):
+        if self._publisher is None:
+            return
+        message = json.dumps({"origin": self.origin, "namespace": namespace, "keys": keys})
+        try:
+            await self._publisher.command("PUBLISH", self.CHANNEL, message)
+        except Exception as e:
+            logger.warning(f"⚠️ Bus d'invalidation indisponible: {e}")
+
+    def on_event(self, topic: str, handler: Callable[[Any], None]):
+        """Call `handler` with the payload of every `topic` event relayed by the other workers"""
+        self.handlers.setdefault(topic, []).append(handler)
+
+    async def relay(self, topic: str, payload: Any):
+        if self._publisher is None:
+            return
+        message = json.dumps({"origin": self.origin, "topic": topic, "payload": jsonable_encoder(payload)})
+        try:
+            await self._publisher.command("PUBLISH", self.CHANNEL, message)
+        except Exception as e:
+            logger.warning(f"⚠️ Bus d'invalidation indisponible: {e}")
+
+    def receive(self, data: bytes):
+        message = json.loads(data)
+        if message["origin"] == self.origin:
+            return
+        if "topic" in message:
+            for handler in self.handlers.get(message["topic"], []):
+                try:
+                    handler(message["payload"])
+                except Exception as e:
+                    logger.error(f"❌ Erreur dans le relais {message['topic']}: {e}")
+            return
+        namespace = self.namespaces.get(message["namespace"])
+        if namespace is not None:
+            namespace.evict_local(message["keys"])
+
+    async def run(self):
+        """Listen for invalidations from the other workers, reconnecting after failures"""
+        while self.url:
+            connection = None
+            try:
+                connection = await RedisConnection.open(self.url)
+                await connection.command("SUBSCRIBE", self.CHANNEL)
+                while True:
+                    reply = await connection.read_reply()
+                    if isinstance(reply, list) and reply[0] == b"message":
+                        self.receive(reply[2])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Entries evicted while disconnected are only bounded by their TTL
+                logger.warning(f"⚠️ Bus d'invalidation déconnecté: {e}")
+                for namespace in self.namespaces.values():
+                    namespace.evict_local(None)
+                for listener in self.disconnect_listeners:
+                    listener()
+                await asyncio.sleep(1)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+class CacheNamespace:
+    """A named cache: an in-process tier, optionally backed by the shared cache.
+
+    `invalidate` evicts a key from both tiers and from the in-process tier of every
+    other worker through the invalidation bus.
+    """
+
+    def __init__(self, name: str, ttl: float, max_entries: int = 10000):
+        self.name = name
+        self.ttl = ttl
+        self.local = InProcessCache(ttl, max_entries)
+        self.shared = shared_cache
+        invalidation_bus.register(self)
+
+    def _key(self, key: str) -> str:
+        return f"cocmarket:{self.name}:{key}"
+
+    async def get(self, key: str) -> Any:
+        return (await self.get_many([key])).get(key)
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        found = await self.local.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing and self.shared is not None:
+            shared = await self.shared.get_many([self._key(key) for key in missing])
+            for key in missing:
+                value = shared.get(self._key(key))
+                if value is not None:
+                    found[key] = value
+                    await self.local.set(key, value, self.ttl)
+        return found
+
+    async def set(self, key: str, value: Any):
+        await self.local.set(key, value, self.ttl)
+        if self.shared is not None:
+            await self.shared.set(self._key(key), value, self.ttl)
+
+    def evict_local(self, keys: Optional[List[str]]):
+        """Drop `keys` (everything when None) from this worker's tier"""
+        if keys is None:
+            self.local.entries.clear()
+        else:
+            for key in keys:
+                self.local.entries.delete(key)
+
+    async def invalidate(self, *keys: str):
+        self.evict_local(list(keys))
+        if self.shared is not None:
+            await self.shared.delete([self._key(key) for key in keys])
+        await invalidation_bus.publish(self.name, list(keys))
+
+    def invalidate_soon(self, *keys: str):
+        """Evict from this worker now and everywhere else in the background (for synchronous callers)"""
+        self.evict_local(list(keys))
+        spawn_background(self.invalidate(*keys))
+
+# CACHE_BACKEND=redis shares cached entries between workers (REDIS_URL, default redis://localhost:6379/0)
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL') or ('redis://localhost:6379/0' if CACHE_BACKEND == 'redis' else None)
+shared_cache: Optional[CacheBackend] = RedisCache(REDIS_URL) if CACHE_BACKEND == 'redis' else None
+invalidation_bus = InvalidationBus(REDIS_URL)
+background_jobs.append(invalidation_bus.run)
+
+product_cache = CacheNamespace("product", ttl=float(os.environ.get('PRODUCT_CACHE_SECONDS', '60')), max_entries=50000)
+session_cache = CacheNamespace("session", ttl=float(os.environ.get('SESSION_CACHE_SECONDS', '60')), max_entries=100000)
+
+async def get_products_by_ids(product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Product documents by id, read through the product cache (missing ids are left out)"""
+    products = await product_cache.get_many(product_ids)
+    missing = [product_id for product_id in product_ids if product_id not in products]
+    if missing:
+        for product in await db.products.find({"id": {"$in": missing}}, {"_id": 0}).to_list(None):
+            products[product["id"]] = product
+            await product_cache.set(product["id"], product)
+    return products
+
+async def warm_up_mongo():
+    """Open the pool's minimum connections before serving, so the first requests skip the handshakes"""
+    await asyncio.gather(*(db.command('ping') for _ in range(max(1, MONGO_MIN_POOL_SIZE))))
+    logger.info(f"🔥 Pool Mongo préchauffé ({max(1, MONGO_MIN_POOL_SIZE)} connexions)")
+
+# Indexes the query paths rely on: (collection, keys, options)
+INDEXES = [
+    ("products", "id", {"unique": True}),
+    ("products", [("is_available", 1), ("created_at", -1)], {}),
+    ("products", [("is_available", 1), ("category", 1), ("created_at", -1)], {}),
+    ("products", [("is_available", 1), ("location", 1), ("created_at", -1)], {}),
+    ("products", [("is_available", 1), ("price", 1)], {}),
+    ("products", [("seller_id", 1), ("is_available", 1), ("created_at", -1)], {}),
+    ("reviews", [("product_id", 1), ("created_at", -1)], {}),
+    ("price_history", [("product_id", 1), ("timestamp", -1)], {}),
+    ("users", "id", {"unique": True}),
+    ("users", "email", {"unique": True}),
+    ("users", "username", {"unique": True}),
+    ("sessions", "token", {"unique": True}),
+    ("sessions", [("user_id", 1), ("created_at", -1)], {}),
+    # Mongo's TTL monitor removes sessions as soon as they expire
+    ("sessions", "expires_at", {"expireAfterSeconds": 0}),
+    ("sessions", "is_active", {"partialFilterExpression": {"is_active": False}}),
+    ("favorites", [("user_id", 1), ("product_id", 1)], {"unique": True}),
+    ("favorites", [("user_id", 1), ("created_at", -1)], {}),
+    ("favorites", "product_id", {}),
+    ("orders", "stripe_session_id", {"unique": True}),
+    ("orders", [("seller_id", 1), ("created_at", -1)], {}),
+    ("orders", [("buyer_id", 1), ("created_at", -1)], {}),
+    ("saved_searches", "id", {"unique": True}),
+    ("saved_searches", [("user_id", 1), ("created_at", -1)], {}),
+    ("notification_outbox", "created_at", {}),
+    ("notifications", "id", {"unique": True}),
+    ("notifications", [("user_id", 1), ("created_at", -1)], {}),
+]
+
+async def ensure_indexes():
+    """Create the indexes the query paths rely on (no-op when they already exist).
+
+    Each index is created on its own, so one failure (e.g. duplicates blocking a
+    unique index) is logged without skipping the others.
+    """
+    # One at a time: building them all at once on a large collection would load the server
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            logger.error(f"❌ Index {collection} {keys} non créé: {e}")
+
+startup_hooks.append(warm_up_mongo)
+startup_hooks.append(ensure_indexes)
+startup_hooks.append(mongo_monitor.attach)
+
+# Product change hooks
+# Listeners are called after every product write with the document before and after
+# the change (None on creation / deletion). They must stay cheap and non-blocking.
+product_change_listeners: List[Callable[[Optional[Dict[str, Any]], Optional[Dict[str, Any]]], None]] = []
+
+def on_product_change(listener):
+    product_change_listeners.append(listener)
+    return listener
+
+def notify_product_change(before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+    for listener in product_change_listeners:
+        try:
+            listener(before, after)
+        except Exception as e:
+            logger.error(f"❌ Erreur dans le hook produit {listener.__name__}: {e}")
+
+@on_product_change
+def record_price_change(before, after):
+    """Append a price history point when a product is listed or its price changes"""
+    if after is None:
+        return
+    if before is not None and before.get("price") == after.get("price"):
+        return
+    price_history_writer.add(PriceHistory(product_id=after["id"], price=after["price"]).dict())
+
+@on_product_change
+def invalidate_cached_product(before, after):
+    """Evict updated and deleted products from the product cache on every worker"""
+    if before is not None:
+        product_cache.invalidate_soon(before["id"])
+
+class GameCounters:
+    """Available listing counts per game, maintained incrementally.
+
+    Product writes adjust the in-memory counts and queue the same deltas, which are
+    flushed to the `game_counters` collection with a single bulk_write. Each flush
+    reloads the collection so counts written by other workers show up, and a
+    periodic reconciliation replaces the counters with a full recount to repair drift.
+    """
+
+    def __init__(self, top_size: int = 20):
+        self.top_size = top_size
+        self.counts: Dict[str, int] = {}
+        self._pending: Dict[str, int] = {}
+        self._top: Optional[List[Dict[str, Any]]] = None
+
+    def apply(self, game_name: str, delta: int):
+        self.counts[game_name] = self.counts.get(game_name, 0) + delta
+        self._pending[game_name] = self._pending.get(game_name, 0) + delta
+        self._top = None
+
+    def top(self) -> List[Dict[str, Any]]:
+        if self._top is None:
+            ranked = sorted(
+                ((name, count) for name, count in self.counts.items() if count > 0),
+                key=lambda item: item[1],
+                reverse=True
+            )[:self.top_size]
+            self._top = [{"name": name, "product_count": count} for name, count in ranked]
+        return self._top
+
+    def _set_counts(self, counts: Dict[str, int]):
+        # Deltas not yet flushed are still ours to add on top of the stored values
+        for name, delta in self._pending.items():
+            counts[name] = counts.get(name, 0) + delta
+        self.counts = counts
+        self._top = None
+
+    async def load(self):
+        stored = await db.game_counters.find({}, {"available_count": 1}).to_list(None)
+        self._set_counts({doc["_id"]: doc["available_count"] for doc in stored})
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        operations = [
+            UpdateOne({"_id": name}, {"$inc": {"available_count": delta}}, upsert=True)
+            for name, delta in pending.items() if delta
+        ]
+        if operations:
+            try:
+                await db.game_counters.bulk_write(operations, ordered=False)
+            except Exception:
+                for name, delta in pending.items():
+                    self._pending[name] = self._pending.get(name, 0) + delta
+                raise
+        await self.load()
+
+    async def reconcile(self):
+        await self.flush()
+        pipeline = [
+            {"$match": {"is_available": True}},
+            {"$group": {"_id": "$game_name", "count": {"$sum": 1}}}
+        ]
+        recount = {doc["_id"]: doc["count"] for doc in await db.products.aggregate(pipeline).to_list(None)}
+        drift = {name: count for name, count in recount.items() if self.counts.get(name, 0) != count}
+        operations = [DeleteMany({"_id": {"$nin": list(recount)}})] + [
+            UpdateOne({"_id": name}, {"$set": {"available_count": count}}, upsert=True)
+            for name, count in recount.items()
+        ]
+        await db.game_counters.bulk_write(operations, ordered=False)
+        self._set_counts(recount)
+        if drift:
+            logger.info(f"🔄 Compteurs de jeux réconciliés: {len(drift)} jeux corrigés")
+
+game_counters = GameCounters()
+startup_hooks.append(game_counters.load)
+background_jobs.append(every(float(os.environ.get('GAME_COUNTERS_FLUSH_SECONDS', '5')), game_counters.flush))
+background_jobs.append(every(float(os.environ.get('GAME_COUNTERS_RECONCILE_SECONDS', '3600')), game_counters.reconcile))
+shutdown_flushes.append(game_counters.flush)
+
+@on_product_change
+def update_game_counters(before, after):
+    """Keep per-game counts of available listings in step with product writes"""
+    was_counted = before is not None and before.get("is_available", True)
+    is_counted = after is not None and after.get("is_available", True)
+    same_game = was_counted and is_counted and before["game_name"] == after["game_name"]
+    if was_counted and not same_game:
+        game_counters.apply(before["game_name"], -1)
+    if is_counted and not same_game:
+        game_counters.apply(after["game_name"], 1)
+
+# Similar listings
+SIMILARITY_TEXT_FIELDS = ("title", "description", "game_name")
+# Fields needed to index a product; images are never loaded
+SIMILARITY_PROJECTION = {
+    "_id": 0, "id": 1, "title": 1, "description": 1, "game_name": 1, "category": 1, "price": 1,
+    "location": 1, "condition": 1, "level": 1, "stats": 1, "is_available": 1,
+}
+TOKEN_PATTERN = re.compile(r"[a-z0-9]{2,}")
+
+def normalize_text(text: str) -> str:
+    """Lowercase and strip accents so that "Épée" and "epee" share a token"""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+def magnitude_bucket(value: float) -> int:
+    return int(math.log2(1 + abs(value)))
+
+SIMILARITY_GAME_TF = 3.0
+SIMILARITY_CATEGORY_TF = 2.0
+
+def game_feature(product: Dict[str, Any]) -> str:
+    return f"game:{normalize_text(product['game_name'])}"
+
+def category_feature(product: Dict[str, Any]) -> str:
+    return f"category:{getattr(product['category'], 'value', product['category'])}"
+
+def listing_features(product: Dict[str, Any]) -> Dict[str, float]:
+    """Term frequencies of a listing: text tokens plus categorical and bucketed numeric features"""
+    features: Dict[str, float] = {}
+    for field in SIMILARITY_TEXT_FIELDS:
+        for token in TOKEN_PATTERN.findall(normalize_text(product.get(field) or "")):
+            features[token] = features.get(token, 0.0) + 1.0
+    # Structured features weigh more than any single word
+    features[game_feature(product)] = SIMILARITY_GAME_TF
+    features[category_feature(product)] = SIMILARITY_CATEGORY_TF
+    features[f"price:{magnitude_bucket(product['price'])}"] = 1.0
+    if product.get("level") is not None:
+        features[f"level:{magnitude_bucket(product['level'])}"] = 1.0
+    for key, value in (product.get("stats") or {}).items():
+        key = normalize_text(str(key))
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            features[f"stat:{key}:{normalize_text(str(value))}"] = 1.0
+        else:
+            features[f"stat:{key}:{magnitude_bucket(value)}"] = 1.0
+    return features
+
+def listing_summary(product: Dict[str, Any]) -> Dict[str, Any]:
+    return {field: product.get(field) for field in ("id", "title", "game_name", "category", "price", "location", "condition")}
+
+class SimilarityIndex:
+    """In-memory TF-IDF index of available listings answering "similar listings" without Mongo.
+
+    Term vectors are stored as CSR arrays: postings (term -> rows) for scoring and
+    per-row terms for building queries. Listings added after the last build go to
+    small delta postings; sold or deleted listings are masked out. A periodic
+    rebuild from Mongo compacts both and refreshes the norms, which drift slightly
+    as document frequencies change between rebuilds.
+    """
+
+    def __init__(self, max_df_ratio: float = 0.1, rebuild_delta: int = 20000, refresh_seconds: float = 900):
+        self.max_df_ratio = max_df_ratio
+        self.rebuild_delta = rebuild_delta
+        self.refresh_seconds = refresh_seconds
+        self.ready = False
+        self.built_at = 0.0
+        self._rebuilding = False
+        self._replay: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]] = []
+        self._load(self._build([]))
+
+    # Building
+    @staticmethod
+    def _build(products: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Vectorize `products` into a fresh index state (CPU only, safe to run in a thread)"""
+        vocabulary: Dict[str, int] = {}
+        doc_indptr = [0]
+        doc_terms: List[int] = []
+        doc_tf: List[float] = []
+        row_game: List[int] = []
+        row_category: List[int] = []
+        for product in products:
+            for term, tf in listing_features(product).items():
+                doc_terms.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_tf.append(tf)
+            doc_indptr.append(len(doc_terms))
+            row_game.append(vocabulary[game_feature(product)])
+            row_category.append(vocabulary[category_feature(product)])
+
+        n_rows, n_terms = len(products), len(vocabulary)
+        doc_indptr = np.asarray(doc_indptr, dtype=np.int64)
+        doc_terms = np.asarray(doc_terms, dtype=np.int32)
+        doc_tf = np.asarray(doc_tf, dtype=np.float32)
+        doc_rows = np.repeat(np.arange(n_rows, dtype=np.int32), np.diff(doc_indptr))
+
+        # Transpose to postings: rows grouped by term
+        order = np.argsort(doc_terms, kind="stable")
+        df = np.bincount(doc_terms, minlength=n_terms).astype(np.float64)
+        post_indptr = np.concatenate(([0], np.cumsum(df))).astype(np.int64)
+        idf = np.log((1 + n_rows) / (1 + df)) + 1
+        weights = doc_tf * idf[doc_terms]
+        norms = np.sqrt(np.bincount(doc_rows, weights=weights * weights, minlength=n_rows)).astype(np.float32)
+
+        return {
+            "vocabulary": vocabulary,
+            "df": df,
+            "row_ids": [product["id"] for product in products],
+            "summaries": [listing_summary(product) for product in products],
+            "alive": np.ones(n_rows, dtype=bool),
+            "norms": norms,
+            "row_game": np.asarray(row_game, dtype=np.int32),
+            "row_category": np.asarray(row_category, dtype=np.int32),
+            "doc_indptr": doc_indptr,
+            "doc_terms": doc_terms,
+            "doc_tf": doc_tf,
+            "post_indptr": post_indptr,
+            "post_rows": doc_rows[order],
+            "post_tf": doc_tf[order],
+        }
+
+    def _load(self, state: Dict[str, Any]):
+        self.vocabulary = state["vocabulary"]
+        self.df = state["df"]
+        self.row_ids = state["row_ids"]
+        self.summaries = state["summaries"]
+        self.alive = state["alive"]
+        self.norms = state["norms"]
+        # Game and category term of every row, to score the broad structured features without their postings
+        self.row_game = state["row_game"]
+        self.row_category = state["row_category"]
+        self.doc_indptr = state["doc_indptr"]
+        self.doc_terms = state["doc_terms"]
+        self.doc_tf = state["doc_tf"]
+        self.post_indptr = state["post_indptr"]
+        self.post_rows = state["post_rows"]
+        self.post_tf = state["post_tf"]
+        self.built_rows = len(self.row_ids)
+        self.rows = {product_id: row for row, product_id in enumerate(self.row_ids)}
+        self.n_alive = len(self.row_ids)
+        # Rows added since the build: row -> (terms, tf) and term -> [(row, tf)]
+        self.delta_docs: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        self.delta_postings: Dict[int, List[Tuple[int, float]]] = {}
+        self._idf = None
+
+    async def rebuild(self):
+        self._rebuilding = True
+        try:
+            products = await db.products.find({"is_available": True}, SIMILARITY_PROJECTION).to_list(None)
+            state = await asyncio.to_thread(self._build, products)
+            self._load(state)
+        finally:
+            self._rebuilding = False
+            replay, self._replay = self._replay, []
+        # Apply the writes that happened while the build was running (harmless if already in the snapshot)
+        for before, after in replay:
+            self.apply(before, after)
+        self.ready = True
+        self.built_at = time.monotonic()
+        logger.info(f"🧭 Index de similarité reconstruit: {self.n_alive} annonces, {len(self.vocabulary)} termes")
+
+    async def run(self, interval: float = 60):
+        """Build at startup, then rebuild when the delta grows too large or the index is old (or the last build failed).
+
+        The periodic rebuild picks up listings written by other workers and bulk changes made without hooks.
+        """
+        while True:
+            if (not self.ready or len(self.delta_docs) >= min(self.rebuild_delta, 100 + self.built_rows // 10)
+                    or time.monotonic() - self.built_at >= self.refresh_seconds):
+                try:
+                    await self.rebuild()
+                except Exception as e:
+                    logger.error(f"❌ Erreur de construction de l'index de similarité: {e}")
+            await asyncio.sleep(interval)
+
+    # Incremental updates
+    def apply(self, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+        if self._rebuilding:
+            self._replay.append((before, after))
+        product_id = (after or before)["id"]
+        if after is None or not after.get("is_available", True):
+            self.remove(product_id)
+        elif before is None or product_id not in self.rows or any(
+            before.get(field) != after.get(field) for field in SIMILARITY_PROJECTION if field != "_id"
+        ):
+            self.remove(product_id)
+            self.add(after)
+
+    def add(self, product: Dict[str, Any]):
+        row = len(self.row_ids)
+        features = listing_features(product)
+        terms = np.fromiter((self.vocabulary.setdefault(term, len(self.vocabulary)) for term in features), dtype=np.int32, count=len(features))
+        tfs = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+        if len(self.vocabulary) > len(self.df):
+            self.df = np.concatenate((self.df, np.zeros(max(len(self.vocabulary) - len(self.df), len(self.df) // 2 + 16))))
+        if row >= len(self.alive):
+            grow = max(1024, len(self.alive) // 2)
+            self.alive = np.concatenate((self.alive, np.zeros(grow, dtype=bool)))
+            self.norms = np.concatenate((self.norms, np.ones(grow, dtype=np.float32)))
+            self.row_game = np.concatenate((self.row_game, np.full(grow, -1, dtype=np.int32)))
+            self.row_category = np.concatenate((self.row_category, np.full(grow, -1, dtype=np.int32)))
+
+        self.df[terms] += 1
+        self.n_alive += 1
+        self._idf = None
+        weights = tfs * self.idf()[terms]
+        self.norms[row] = np.sqrt(np.dot(weights, weights))
+        self.alive[row] = True
+        self.row_game[row] = self.vocabulary[game_feature(product)]
+        self.row_category[row] = self.vocabulary[category_feature(product)]
+        self.row_ids.append(product["id"])
+        self.summaries.append(listing_summary(product))
+        self.rows[product["id"]] = row
+        self.delta_docs[row] = (terms, tfs)
+        for term, tf in zip(terms.tolist(), tfs.tolist()):
+            self.delta_postings.setdefault(term, []).append((row, tf))
+
+    def remove(self, product_id: str):
+        row = self.rows.pop(product_id, None)
+        if row is None:
+            return
+        terms, _ = self.row_terms(row)
+        self.df[terms] -= 1
+        self.n_alive -= 1
+        self.alive[row] = False
+        self._idf = None
+
+    # Querying
+    def idf(self) -> np.ndarray:
+        if self._idf is None:
+            self._idf = np.log((1 + self.n_alive) / (1 + np.maximum(self.df, 0))) + 1
+        return self._idf
+
+    def row_terms(self, row: int) -> Tuple[np.ndarray, np.ndarray]:
+        if row < self.built_rows:
+            start, end = self.doc_indptr[row], self.doc_indptr[row + 1]
+            return self.doc_terms[start:end], self.doc_tf[start:end]
+        return self.delta_docs[row]
+
+    def query_vector(self, row: int) -> Tuple[np.ndarray, np.ndarray, Dict[int, float]]:
+        """Unit-length TF-IDF weights of an indexed row: selective terms, then broad game/category weights"""
+        terms, tfs = self.row_terms(row)
+        idf = self.idf()
+        weights = tfs * idf[terms]
+        weights = weights / (float(np.sqrt(np.dot(weights, weights))) or 1.0)
+        # Terms present in a large share of listings carry little signal but dominate the cost
+        selective = self.df[terms] <= max(10.0, self.max_df_ratio * self.n_alive)
+        # Postings hold raw term frequencies, so the document side's idf is folded into the query
+        query_weights = weights * idf[terms]
+        # A popular game or category is too broad for its postings, but still decides between candidates
+        broad = {
+            term: weight for term, weight, is_selective in zip(terms.tolist(), query_weights.tolist(), selective.tolist())
+            if not is_selective and term in (self.row_game[row], self.row_category[row])
+        }
+        return terms[selective], query_weights[selective], broad
+
+    def similar(self, product_ids: List[str], k: int = 8) -> Dict[str, List[Dict[str, Any]]]:
+        """Cosine top-k neighbours for a batch of indexed products"""
+        results: Dict[str, List[Dict[str, Any]]] = {}
+        n_rows = len(self.row_ids)
+        for product_id in product_ids:
+            row = self.rows.get(product_id)
+            if row is None:
+                continue
+            terms, weights, broad = self.query_vector(row)
+            row_parts, weight_parts = [], []
+            for term, weight in zip(terms.tolist(), weights.tolist()):
+                if term + 1 < len(self.post_indptr):
+                    start, end = self.post_indptr[term], self.post_indptr[term + 1]
+                    row_parts.append(self.post_rows[start:end])
+                    weight_parts.append(self.post_tf[start:end] * weight)
+                delta = self.delta_postings.get(term)
+                if delta:
+                    delta = np.asarray(delta)
+                    row_parts.append(delta[:, 0].astype(np.int32))
+                    weight_parts.append(delta[:, 1] * weight)
+            results[product_id] = []
+            
+            # Dot products of every candidate sharing a term, accumulated in one pass
+            if row_parts:
+                dots = np.bincount(np.concatenate(row_parts), weights=np.concatenate(weight_parts), minlength=n_rows)
+            else:
+                dots = np.zeros(n_rows)
+            dots[row] = 0
+            candidates = np.flatnonzero(dots)
+            candidates = candidates[self.alive[candidates]]
+            if len(candidates) < k and broad:
+                # Too few listings share a selective term: fall back to the same game or category
+                same = np.isin(self.row_game[:n_rows], list(broad)) | np.isin(self.row_category[:n_rows], list(broad))
+                same &= self.alive[:n_rows]
+                same[row] = False
+                candidates = np.union1d(candidates, np.flatnonzero(same))
+            if not len(candidates):
+                continue
+            scores = dots[candidates]
+            for term, weight in broad.items():
+                scores = scores + weight * (
+                    SIMILARITY_GAME_TF * (self.row_game[candidates] == term)
+                    + SIMILARITY_CATEGORY_TF * (self.row_category[candidates] == term)
+                )
+            # Norms of rows added since the build drift as document frequencies change; cap at 1
+            scores = np.minimum(scores / np.maximum(self.norms[candidates], 1e-9), 1.0)
+            if len(candidates) > k:
+                top = np.argpartition(-scores, k)[:k]
+                candidates, scores = candidates[top], scores[top]
+            for position in np.argsort(-scores, kind="stable").tolist():
+                results[product_id].append({**self.summaries[candidates[position]], "score": round(float(scores[position]), 4)})
+        return results
+
+similarity_index = SimilarityIndex(
+    max_df_ratio=float(os.environ.get('SIMILARITY_MAX_DF_RATIO', '0.1')),
+    rebuild_delta=int(os.environ.get('SIMILARITY_REBUILD_DELTA', '20000')),
+    refresh_seconds=float(os.environ.get('SIMILARITY_REFRESH_SECONDS', '900')),
+)
+background_jobs.append(similarity_index.run)
+
+@on_product_change
+def update_similarity_index(before, after):
+    """Index new and edited listings, and drop sold or deleted ones"""
+    similarity_index.apply(before, after)
+
+# Fair-price estimator
+PRICE_PERCENTILES = np.array([5, 25, 50, 75, 95])
+# Groups smaller than this are reported but never used to judge a price
+MIN_PRICE_SAMPLE = int(os.environ.get('PRICE_INSIGHT_MIN_SAMPLE', '5'))
+# Modified z-score above which a price is an outlier (Iglewicz & Hoaglin)
+PRICE_OUTLIER_THRESHOLD = 3.5
+PRICE_GROUP_FIELDS = ("game_name", "category", "condition")
+PRICE_PROJECTION = {"_id": 0, "id": 1, "price": 1, "is_available": 1, **{field: 1 for field in PRICE_GROUP_FIELDS}}
+
+def price_group(product: Dict[str, Any]) -> Tuple[str, str, str]:
+    return tuple(str(getattr(product.get(field), "value", product.get(field))) for field in PRICE_GROUP_FIELDS)
+
+def grouped_percentiles(values: np.ndarray, starts: np.ndarray, counts: np.ndarray, percentiles: np.ndarray) -> np.ndarray:
+    """Linearly interpolated percentiles of every group of `values`, sorted within contiguous groups"""
+    positions = starts[:, None] + (counts[:, None] - 1) * (percentiles[None, :] / 100)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, (starts + counts - 1)[:, None])
+    fraction = positions - lower
+    return values[lower] * (1 - fraction) + values[upper] * fraction
+
+def price_group_stats(codes: np.ndarray, prices: np.ndarray, n_groups: int) -> Dict[str, np.ndarray]:
+    """Percentiles, median absolute deviation and robust scale of every price group in one vectorized pass"""
+    order = np.lexsort((prices, codes))
+    codes, prices = codes[order], prices[order]
+    counts = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    percentiles = grouped_percentiles(prices, starts, counts, PRICE_PERCENTILES)
+    median = percentiles[:, 2]
+    
+    deviations = np.abs(prices - median[codes])
+    mean_deviation = np.bincount(codes, weights=deviations, minlength=n_groups) / counts
+    deviations = deviations[np.lexsort((deviations, codes))]
+    mad = grouped_percentiles(deviations, starts, counts, np.array([50]))[:, 0]
+    # 1.4826 * MAD estimates the standard deviation; fall back to the mean deviation when
+    # more than half of a group shares the same price
+    scale = np.where(mad > 0, 1.4826 * mad, 1.2533 * mean_deviation)
+    return {
+        "prices": prices, "starts": starts, "counts": counts, "percentiles": percentiles,
+        "mad": mad, "scale": scale,
+    }
+
+class PriceEstimator:
+    """Price distributions of available listings per (game, category, condition).
+
+    Listing prices are mirrored in memory through the product hooks; groups touched
+    since the last refresh are marked dirty and recomputed together in a worker
+    thread, so requests only read precomputed statistics.
+    """
+
+    def __init__(self, refresh_interval: float = 10, reload_interval: float = 900):
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.ready = False
+        self.loaded_at = 0.0
+        self.listings: Dict[str, Tuple[Tuple[str, str, str], float]] = {}
+        self.groups: Dict[Tuple[str, str, str], Dict[str, float]] = {}
+        self.stats: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self.dirty: set = set()
+        self._loading = False
+        self._replay: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]] = []
+
+    def apply(self, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+        if self._loading:
+            self._replay.append((before, after))
+        product_id = (after or before)["id"]
+        self.remove(product_id)
+        if after is not None and after.get("is_available", True):
+            self.add(product_id, price_group(after), float(after["price"]))
+
+    def add(self, product_id: str, group: Tuple[str, str, str], price: float):
+        self.listings[product_id] = (group, price)
+        self.groups.setdefault(group, {})[product_id] = price
+        self.dirty.add(group)
+
+    def remove(self, product_id: str):
+        listing = self.listings.pop(product_id, None)
+        if listing is None:
+            return
+        group = listing[0]
+        members = self.groups[group]
+        del members[product_id]
+        if not members:
+            del self.groups[group]
+        self.dirty.add(group)
+
+    async def load(self):
+        """Mirror every available listing from Mongo, then compute all groups (the previous statistics serve meanwhile)"""
+        self._loading = True
+        try:
+            products = await db.products.find({"is_available": True}, PRICE_PROJECTION).to_list(None)
+        finally:
+            self._loading = False
+            replay, self._replay = self._replay, []
+        self.listings, self.groups, self.dirty = {}, {}, set()
+        for product in products:
+            self.add(product["id"], price_group(product), float(product["price"]))
+        for before, after in replay:
+            self.apply(before, after)
+        await self.refresh()
+        for group in set(self.stats) - set(self.groups):
+            del self.stats[group]
+        self.ready = True
+        self.loaded_at = time.monotonic()
+        logger.info(f"💶 Estimateur de prix chargé: {len(self.listings)} annonces, {len(self.stats)} groupes")
+
+    async def refresh(self):
+        """Recompute the statistics of the groups changed since the last refresh"""
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        keys = [group for group in dirty if group in self.groups]
+        for group in dirty - set(keys):
+            self.stats.pop(group, None)
+        if not keys:
+            return
+        # Snapshot on the event loop; the hooks keep mutating the dicts meanwhile
+        sizes = [len(self.groups[group]) for group in keys]
+        prices = np.fromiter((price for group in keys for price in self.groups[group].values()), dtype=np.float64, count=sum(sizes))
+        codes = np.repeat(np.arange(len(keys)), sizes)
+        computed = await asyncio.to_thread(price_group_stats, codes, prices, len(keys))
+        
+        updated_at = datetime.utcnow()
+        for code, group in enumerate(keys):
+            start, count = computed["starts"][code], computed["counts"][code]
+            percentiles = computed["percentiles"][code]
+            self.stats[group] = {
+                "game_name": group[0],
+                "category": group[1],
+                "condition": group[2],
+                "sample_size": int(count),
+                "min": round(float(computed["prices"][start]), 2),
+                "p5": round(float(percentiles[0]), 2),
+                "p25": round(float(percentiles[1]), 2),
+                "median": round(float(percentiles[2]), 2),
+                "p75": round(float(percentiles[3]), 2),
+                "p95": round(float(percentiles[4]), 2),
+                "max": round(float(computed["prices"][start + count - 1]), 2),
+                "mad": round(float(computed["mad"][code]), 2),
+                "scale": float(computed["scale"][code]),
+                "sorted_prices": computed["prices"][start:start + count],
+                "updated_at": updated_at,
+            }
+
+    async def run(self):
+        """Load at startup (retrying on failure), then refresh the dirty groups periodically.
+
+        A periodic full reload picks up listings written by other workers and bulk changes made without hooks.
+        """
+        while True:
+            try:
+                if self.ready and time.monotonic() - self.loaded_at < self.reload_interval:
+                    await self.refresh()
+                else:
+                    await self.load()
+            except Exception as e:
+                logger.error(f"❌ Erreur de l'estimateur de prix: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def insight(self, product_id: str, group: Tuple[str, str, str], price: float) -> Dict[str, Any]:
+        stats = self.stats.get(group)
+        insight = {"product_id": product_id, "price": price, "group": None, "percentile_rank": None,
+                   "robust_z": None, "verdict": "insufficient_data", "is_outlier": False}
+        if stats is None:
+            return insight
+        insight["group"] = stats
+        if stats["sample_size"] < MIN_PRICE_SAMPLE:
+            return insight
+        
+        sorted_prices = stats["sorted_prices"]
+        below = np.searchsorted(sorted_prices, price, side="left")
+        at_or_below = np.searchsorted(sorted_prices, price, side="right")
+        insight["percentile_rank"] = round(100 * (below + at_or_below) / (2 * len(sorted_prices)), 1)
+        robust_z = (price - stats["median"]) / stats["scale"] if stats["scale"] > 0 else 0.0
+        insight["robust_z"] = round(robust_z, 2)
+        insight["is_outlier"] = abs(robust_z) > PRICE_OUTLIER_THRESHOLD
+        insight["verdict"] = "low" if price < stats["p25"] else "high" if price > stats["p75"] else "fair"
+        return insight
+
+    def game_distribution(self, game_name: str) -> List[Dict[str, Any]]:
+        wanted = game_name.lower()
+        return sorted(
+            (stats for group, stats in self.stats.items() if group[0].lower() == wanted),
+            key=lambda stats: -stats["sample_size"]
+        )
+
+price_estimator = PriceEstimator(
+    refresh_interval=float(os.environ.get('PRICE_INSIGHT_REFRESH_SECONDS', '10')),
+    reload_interval=float(os.environ.get('PRICE_INSIGHT_RELOAD_SECONDS', '900')),
+)
+background_jobs.append(price_estimator.run)
+
+@on_product_change
+def update_price_estimator(before, after):
+    """Move listings between price groups as they are listed, repriced or sold"""
+    was_listed = before is not None and before.get("is_available", True)
+    is_listed = after is not None and after.get("is_available", True)
+    if not was_listed and not is_listed:
+        return
+    if was_listed and is_listed and before["price"] == after["price"] and price_group(before) == price_group(after):
+        return
+    price_estimator.apply(before, after)
+
+# Autocomplete
+AUTOCOMPLETE_STOPWORDS = {"pour", "avec", "les", "des", "une", "the", "and", "for", "with"}
+# Prefix ranges wider than this are answered from a short-lived cache
+AUTOCOMPLETE_SCAN_LIMIT = 256
+
+def title_terms(title: str) -> set:
+    return {token for token in TOKEN_PATTERN.findall(normalize_text(title)) if len(token) >= 3 and token not in AUTOCOMPLETE_STOPWORDS}
+
+class PrefixIndex:
+    """Sorted keys answering prefix queries with bisect, weighted by a listing count per key"""
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.counts: Dict[str, int] = {}
+        self.labels: Dict[str, str] = {}
+
+    def load(self, counts: Dict[str, int], labels: Dict[str, str]):
+        self.counts = counts
+        self.labels = labels
+        self.keys = sorted(counts)
+
+    def add(self, key: str, label: str, delta: int):
+        count = self.counts.get(key, 0) + delta
+        if count > 0:
+            if key not in self.counts:
+                bisect.insort(self.keys, key)
+                self.labels[key] = label
+            self.counts[key] = count
+        elif key in self.counts:
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            del self.counts[key]
+            del self.labels[key]
+
+    def prefix_range(self, prefix: str) -> Tuple[int, int]:
+        return bisect.bisect_left(self.keys, prefix), bisect.bisect_left(self.keys, prefix + "\uffff")
+
+    def top(self, start: int, end: int, limit: int) -> List[Tuple[int, str]]:
+        counts = self.counts
+        return heapq.nlargest(limit, ((counts[key], key) for key in self.keys[start:end]))
+
+class AutocompleteIndex:
+    """Typeahead over game names and title words of available listings.
+
+    Game names match the whole query and title words match single-word queries;
+    both are ranked by the number of available listings they appear in. Kept
+    current by the product hooks, with a periodic reload from Mongo.
+    """
+
+    def __init__(self, reload_interval: float = 3600):
+        self.reload_interval = reload_interval
+        self.ready = False
+        self.games = PrefixIndex()
+        self.terms = PrefixIndex()
+        self.wide_prefixes = TTLCache(ttl=5, max_entries=4096)
+        self._loading = False
+        self._replay: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]] = []
+
+    @staticmethod
+    def _count(products: List[Dict[str, Any]]):
+        game_counts: Dict[str, int] = {}
+        game_labels: Dict[str, str] = {}
+        term_counts: Dict[str, int] = {}
+        for product in products:
+            game = normalize_text(product["game_name"]).strip()
+            game_counts[game] = game_counts.get(game, 0) + 1
+            game_labels.setdefault(game, product["game_name"])
+            for term in title_terms(product["title"]):
+                term_counts[term] = term_counts.get(term, 0) + 1
+        return game_counts, game_labels, term_counts
+
+    async def load(self):
+        self._loading = True
+        try:
+            products = await db.products.find({"is_available": True}, {"_id": 0, "game_name": 1, "title": 1}).to_list(None)
+            game_counts, game_labels, term_counts = await asyncio.to_thread(self._count, products)
+        finally:
+            self._loading = False
+            replay, self._replay = self._replay, []
+        self.games.load(game_counts, game_labels)
+        self.terms.load(term_counts, {term: term for term in term_counts})
+        # Writes made during the load may already be in the snapshot; the next reload evens that out
+        for before, after in replay:
+            self.apply(before, after)
+        self.wide_prefixes.clear()
+        self.ready = True
+        logger.info(f"🔤 Index d'autocomplétion chargé: {len(self.games.keys)} jeux, {len(self.terms.keys)} mots")
+
+    async def run(self):
+        """Load at startup, then reload periodically so counts cannot drift for long"""
+        while True:
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"❌ Erreur de chargement de l'autocomplétion: {e}")
+            await asyncio.sleep(self.reload_interval if self.ready else 30)
+
+    def apply(self, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+        if self._loading:
+            self._replay.append((before, after))
+        if before is not None:
+            self.add(before, -1)
+        if after is not None:
+            self.add(after, 1)
+
+    def add(self, product: Dict[str, Any], delta: int):
+        self.games.add(normalize_text(product["game_name"]).strip(), product["game_name"], delta)
+        for term in title_terms(product["title"]):
+            self.terms.add(term, term, delta)
+
+    def suggest(self, query: str, limit: int = 8) -> List[Dict[str, Any]]:
+        prefix = " ".join(normalize_text(query).split())
+        if not prefix:
+            return []
+        sources = [("game", self.games)] if " " in prefix else [("game", self.games), ("term", self.terms)]
+        
+        candidates = []
+        for kind, index in sources:
+            start, end = index.prefix_range(prefix)
+            if end - start > AUTOCOMPLETE_SCAN_LIMIT:
+                cache_key = (kind, prefix, limit)
+                top = self.wide_prefixes.get(cache_key)
+                if top is None:
+                    top = index.top(start, end, limit)
+                    self.wide_prefixes.set(cache_key, top)
+            else:
+                top = index.top(start, end, limit)
+            candidates.extend((count, kind, index.labels.get(key, key)) for count, key in top)
+        
+        suggestions, seen = [], set()
+        for count, kind, label in sorted(candidates, key=lambda candidate: -candidate[0]):
+            if label.lower() in seen:
+                continue
+            seen.add(label.lower())
+            suggestions.append({"text": label, "kind": kind, "count": count})
+            if len(suggestions) == limit:
+                break
+        return suggestions
+
+autocomplete_index = AutocompleteIndex(
+    reload_interval=float(os.environ.get('AUTOCOMPLETE_RELOAD_SECONDS', '3600'))
+)
+background_jobs.append(autocomplete_index.run)
+
+@on_product_change
+def update_autocomplete_index(before, after):
+    """Count a listing's game and title words while it is available"""
+    was_listed = before is not None and before.get("is_available", True)
+    is_listed = after is not None and after.get("is_available", True)
+    if was_listed and is_listed and before["title"] == after["title"] and before["game_name"] == after["game_name"]:
+        return
+    autocomplete_index.apply(before if was_listed else None, after if is_listed else None)
+
+# Live product feed
+FEED_QUEUE_SIZE = int(os.environ.get('FEED_QUEUE_SIZE', '100'))
+FEED_MAX_SUBSCRIBERS = int(os.environ.get('FEED_MAX_SUBSCRIBERS', '20000'))
+FEED_HEARTBEAT_SECONDS = float(os.environ.get('FEED_HEARTBEAT_SECONDS', '15'))
+FEED_REPLAY_EVENTS = int(os.environ.get('FEED_REPLAY_EVENTS', '1000'))
+FEED_MAX_SEARCH_LENGTH = 100
+# Tells clients their stream has gaps (overflow, restart, other worker) and they should refetch
+FEED_RESYNC = b"event: resync\ndata: {}\n\n"
+FEED_HEARTBEAT = b": ping\n\n"
+
+metrics.declare("feed_subscribers", "gauge", "Open live feed connections")
+metrics.declare("feed_events_total", "counter", "Product events published to the live feed per type")
+metrics.declare("feed_overflows_total", "counter", "Live feed subscribers that fell behind and were asked to resync")
+
+def compile_product_filter(filters: Dict[str, Any]) -> Callable[[Dict[str, Any]], bool]:
+    """Python predicate equivalent to a Mongo filter produced by build_product_filters.
+
+    Regex conditions (game_name, search) are matched as case-insensitive substrings.
+    """
+    checks = []
+    for field, condition in filters.items():
+        if field == "$or":
+            alternatives = [compile_product_filter(alternative) for alternative in condition]
+            checks.append(lambda product, alternatives=alternatives: any(check(product) for check in alternatives))
+        elif isinstance(condition, dict) and "$regex" in condition:
+            # Matched as plain text: a user's pattern must never run as a regex on the event loop
+            needle = condition["$regex"].casefold()
+            checks.append(lambda product, field=field, needle=needle: needle in str(product.get(field) or "").casefold())
+        elif isinstance(condition, dict):
+            low, high = condition.get("$gte"), condition.get("$lte")
+            checks.append(lambda product, field=field, low=low, high=high: product.get(field) is not None
+                          and (low is None or product[field] >= low) and (high is None or product[field] <= high))
+        else:
+            checks.append(lambda product, field=field, value=condition: product.get(field, True if field == "is_available" else None) == value)
+    return lambda product: all(check(product) for check in checks)
+
+def product_event_type(before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]) -> str:
+    if before is None:
+        return "created"
+    if after is None:
+        return "deleted"
+    was_available, is_available = before.get("is_available", True), after.get("is_available", True)
+    if was_available and not is_available:
+        return "unavailable"
+    if is_available and not was_available:
+        return "available"
+    if before.get("price") != after.get("price"):
+        return "price_change"
+    return "updated"
+
+class FeedSubscription:
+    __slots__ = ("group", "queue")
+
+    def __init__(self, group: "FeedFilterGroup"):
+        self.group = group
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=FEED_QUEUE_SIZE)
+
+    def push(self, message: bytes):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # A slow client gets one resync instead of an unbounded backlog
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(FEED_RESYNC)
+            metrics.inc("feed_overflows_total")
+
+class FeedFilterGroup:
+    """Subscribers sharing the same filters, so the predicate runs once per event for all of them"""
+    __slots__ = ("key", "category", "matches", "subscriptions")
+
+    def __init__(self, key: str, category: Optional[str], matches: Callable[[Dict[str, Any]], bool]):
+        self.key = key
+        self.category = category
+        self.matches = matches
+        self.subscriptions: set = set()
+
+    def accepts(self, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]) -> bool:
+        # Listings leaving the filter (sold, deleted, repriced out of range) are announced too
+        return (after is not None and self.matches(after)) or (before is not None and self.matches(before))
+
+class ProductEventBus:
+    """In-process pub/sub for product events, fanned out to live feed subscribers.
+
+    Each event is serialized once. Subscribers are grouped by identical filters and
+    the groups are indexed by category, so an event evaluates each relevant filter
+    once and then only pushes to bounded queues. Recent events are kept so a client
+    reconnecting with Last-Event-ID misses nothing.
+    """
+
+    def __init__(self):
+        # Event ids are only meaningful within this process
+        self.epoch = secrets.token_hex(4)
+        self.sequence = 0
+        self.groups: Dict[Optional[str], Dict[str, FeedFilterGroup]] = {}
+        self.subscriber_count = 0
+        self.recent: "deque[Tuple[int, Optional[Dict[str, Any]], Optional[Dict[str, Any]], bytes]]" = deque(maxlen=FEED_REPLAY_EVENTS)
+
+    def subscribe(self, filters: Dict[str, Any], last_event_id: Optional[str] = None) -> FeedSubscription:
+        category = filters.get("category")
+        category = getattr(category, "value", category)
+        key = json.dumps(jsonable_encoder(filters), sort_keys=True)
+        groups = self.groups.setdefault(category, {})
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = FeedFilterGroup(key, category, compile_product_filter(filters))
+        subscription = FeedSubscription(group)
+        group.subscriptions.add(subscription)
+        self.subscriber_count += 1
+        metrics.set("feed_subscribers", self.subscriber_count)
+        if last_event_id is not None:
+            self.replay(subscription, last_event_id)
+        return subscription
+
+    def unsubscribe(self, subscription: FeedSubscription):
+        group = subscription.group
+        if subscription not in group.subscriptions:
+            return
+        group.subscriptions.discard(subscription)
+        self.subscriber_count -= 1
+        if not group.subscriptions:
+            groups = self.groups[group.category]
+            del groups[group.key]
+            if not groups:
+                del self.groups[group.category]
+        metrics.set("feed_subscribers", self.subscriber_count)
+
+    def replay(self, subscription: FeedSubscription, last_event_id: str):
+        epoch, _, sequence = last_event_id.partition("-")
+        if epoch != self.epoch or not sequence.isdigit() or (self.recent and int(sequence) < self.recent[0][0] - 1):
+            subscription.push(FEED_RESYNC)
+            return
+        for event_sequence, before, after, message in self.recent:
+            if event_sequence > int(sequence) and subscription.group.accepts(before, after):
+                subscription.push(message)
+
+    def publish(self, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+        self.sequence += 1
+        event_type = product_event_type(before, after)
+        payload = {"type": event_type, "product": feed_document(after or before)}
+        if event_type == "price_change":
+            payload["previous_price"] = before["price"]
+        message = (
+            f"id: {self.epoch}-{self.sequence}\nevent: {event_type}\n"
+            f"data: {json.dumps(jsonable_encoder(payload), separators=(',', ':'))}\n\n"
+        ).encode()
+        metrics.inc("feed_events_total", (("type", event_type),))
+        self.recent.append((self.sequence, before, after, message))
+        
+        categories = {getattr(document["category"], "value", document["category"]) for document in (before, after) if document}
+        for category in (None, *categories):
+            for group in self.groups.get(category, {}).values():
+                if group.accepts(before, after):
+                    for subscription in group.subscriptions:
+                        subscription.push(message)
+
+    def resync_all(self):
+        """Ask every subscriber to reload (events from other workers may have been lost)"""
+        for groups in self.groups.values():
+            for group in groups.values():
+                for subscription in group.subscriptions:
+                    subscription.push(FEED_RESYNC)
+
+product_event_bus = ProductEventBus()
+
+def feed_document(document: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    return None if document is None else {key: value for key, value in document.items() if key not in ("_id", "images")}
+
+@on_product_change
+def publish_product_event(before, after):
+    """Push every product write to the live feed, here and on the other workers"""
+    product_event_bus.publish(before, after)
+    if invalidation_bus.url:
+        spawn_background(invalidation_bus.relay("product_event", {"before": feed_document(before), "after": feed_document(after)}))
+
+invalidation_bus.on_event("product_event", lambda payload: product_event_bus.publish(payload["before"], payload["after"]))
+invalidation_bus.disconnect_listeners.append(product_event_bus.resync_all)
+
+# Session lifecycle
+SESSION_LIFETIME = timedelta(days=30)
+MAX_SESSIONS_PER_USER = int(os.environ.get('MAX_SESSIONS_PER_USER', '5'))
+SESSION_SWEEP_BATCH = int(os.environ.get('SESSION_SWEEP_BATCH', '1000'))
+
+def new_session(user_id: str) -> UserSession:
+    return UserSession(
+        user_id=user_id,
+        token=generate_session_token(),
+        expires_at=datetime.utcnow().replace(microsecond=0) + SESSION_LIFETIME
+    )
+
+async def trim_user_sessions(user_id: str, keep_token: str):
+    """Delete a user's oldest sessions so that, with `keep_token`, at most MAX_SESSIONS_PER_USER remain"""
+    stale = await db.sessions.find(
+        {"user_id": user_id, "token": {"$ne": keep_token}}, {"_id": 1, "token": 1}
+    ).sort("created_at", -1).skip(MAX_SESSIONS_PER_USER - 1).to_list(None)
+    if stale:
+        await db.sessions.delete_many({"_id": {"$in": [doc["_id"] for doc in stale]}})
+        # Otherwise the trimmed tokens keep authenticating until their cache entry expires
+        await session_cache.invalidate(*[doc["token"] for doc in stale])
+
+async def store_session(session: UserSession, trim: bool = True):
+    """Insert a session; the per-user cap is enforced afterwards, off the request path"""
+    await db.sessions.insert_one(session.dict())
+    if trim:
+        spawn_background(trim_user_sessions(session.user_id, session.token))
+
+def duplicate_key_field(error: DuplicateKeyError) -> Optional[str]:
+    """Name of the uniquely indexed field a DuplicateKeyError was raised for"""
+    details = error.details or {}
+    key_pattern = details.get("keyPattern") or details.get("keyValue")
+    if key_pattern:
+        return next(iter(key_pattern))
+    # Older servers only mention the index name in the message
+    for field in ("email", "username"):
+        if f"{field}_1" in str(error):
+            return field
+    return None
+
+# 400 responses for unique index violations on users
+DUPLICATE_USER_ERRORS = {
+    "email": "Email already registered",
+    "username": "Username already taken",
+}
+
+async def sweep_sessions():
+    """Remove deactivated and expired sessions in small batches (the TTL index only runs once a minute)"""
+    removed = 0
+    while True:
+        stale = await db.sessions.find(
+            {"$or": [{"is_active": False}, {"expires_at": {"$lte": datetime.utcnow()}}]}, {"_id": 1, "token": 1}
+        ).limit(SESSION_SWEEP_BATCH).to_list(None)
+        if not stale:
+            break
+        result = await db.sessions.delete_many({"_id": {"$in": [doc["_id"] for doc in stale]}})
+        await session_cache.invalidate(*[doc["token"] for doc in stale])
+        removed += result.deleted_count
+        if len(stale) < SESSION_SWEEP_BATCH:
+            break
+    if removed:
+        logger.info(f"🧹 Sessions purgées: {removed}")
+
+background_jobs.append(every(float(os.environ.get('SESSION_SWEEP_SECONDS', '600')), sweep_sessions))
+
+# Presence
+# A user is online while their last heartbeat is more recent than this
+PRESENCE_TTL_SECONDS = float(os.environ.get('PRESENCE_TTL_SECONDS', '60'))
+PRESENCE_FLUSH_SECONDS = float(os.environ.get('PRESENCE_FLUSH_SECONDS', '15'))
+
+metrics.declare("presence_online_users", "gauge", "Users with a recent heartbeat on this worker")
+
+async def session_user_id(token: str) -> str:
+    """User id of a valid session token, through the session cache (logout invalidates it)"""
+    user_id = await session_cache.get(token)
+    if user_id is None:
+        session = await db.sessions.find_one(
+            {"token": token, "is_active": True, "expires_at": {"$gt": datetime.utcnow()}},
+            {"_id": 0, "user_id": 1}
+        )
+        if not session:
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
+        user_id = session["user_id"]
+        await session_cache.set(token, user_id)
+    return user_id
+
+class PresenceTable:
+    """Last heartbeat per user, kept in memory and persisted as last_seen in periodic bulk writes.
+
+    Each worker only sees the heartbeats it served, so reads combine the local
+    table with the last_seen stored by the other workers' flushes.
+    """
+
+    def __init__(self):
+        self.seen: Dict[str, datetime] = {}
+        self.unflushed: Dict[str, datetime] = {}
+
+    def beat(self, user_id: str):
+        now = datetime.utcnow()
+        self.seen[user_id] = now
+        self.unflushed[user_id] = now
+
+    def last_seen(self, user_id: str, stored: Optional[datetime] = None) -> Optional[datetime]:
+        local = self.seen.get(user_id)
+        if local is None or (stored is not None and stored > local):
+            return stored
+        return local
+
+    def is_online(self, user_id: str, stored: Optional[datetime] = None) -> bool:
+        last_seen = self.last_seen(user_id, stored)
+        return last_seen is not None and datetime.utcnow() - last_seen < timedelta(seconds=PRESENCE_TTL_SECONDS)
+
+    async def flush(self):
+        """Write pending last_seen values in one unordered bulk_write, then expire stale entries"""
+        pending, self.unflushed = self.unflushed, {}
+        if pending:
+            try:
+                # $max keeps a newer value written by another worker
+                await db.users.bulk_write(
+                    [UpdateOne({"id": user_id}, {"$max": {"last_seen": seen}}) for user_id, seen in pending.items()],
+                    ordered=False
+                )
+            except Exception:
+                for user_id, seen in pending.items():
+                    self.unflushed.setdefault(user_id, seen)
+                raise
+        
+        cutoff = datetime.utcnow() - timedelta(seconds=PRESENCE_TTL_SECONDS)
+        for user_id in [user_id for user_id, seen in self.seen.items() if seen < cutoff]:
+            del self.seen[user_id]
+        metrics.set("presence_online_users", len(self.seen))
+
+presence = PresenceTable()
+background_jobs.append(every(PRESENCE_FLUSH_SECONDS, presence.flush))
+shutdown_flushes.append(presence.flush)
+
+# Favorite counters
+class FavoriteCounters:
+    """Buffered favorite_count increments.
+
+    Favoriting only adds to an in-memory delta per product; deltas are applied with
+    one unordered bulk_write per flush, so a listing favorited thousands of times
+    between flushes receives a single $inc. A periodic reconciliation recounts the
+    favorites collection to repair drift (lost flushes, crashes, deleted favorites).
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, int] = {}
+
+    def apply(self, product_id: str, delta: int):
+        self._pending[product_id] = self._pending.get(product_id, 0) + delta
+
+    def pending(self, product_id: str) -> int:
+        """Delta not yet written for `product_id`, so reads on this worker are not behind"""
+        return self._pending.get(product_id, 0)
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        operations = [
+            UpdateOne({"id": product_id}, {"$inc": {"favorite_count": delta}})
+            for product_id, delta in pending.items() if delta
+        ]
+        if operations:
+            try:
+                await db.products.bulk_write(operations, ordered=False)
+            except Exception:
+                for product_id, delta in pending.items():
+                    self._pending[product_id] = self._pending.get(product_id, 0) + delta
+                raise
+
+    async def reconcile(self):
+        await self.flush()
+        pipeline = [{"$group": {"_id": "$product_id", "count": {"$sum": 1}}}]
+        recount = {doc["_id"]: doc["count"] for doc in await db.favorites.aggregate(pipeline).to_list(None)}
+        stored = await db.products.find(
+            {"$or": [{"favorite_count": {"$ne": 0}}, {"id": {"$in": list(recount)}}]},
+            {"_id": 0, "id": 1, "favorite_count": 1}
+        ).to_list(None)
+        # Favorites added while recounting may be counted again by the next flush; the next run evens that out
+        operations = [
+            UpdateOne({"id": doc["id"]}, {"$set": {"favorite_count": recount.get(doc["id"], 0)}})
+            for doc in stored if doc.get("favorite_count", 0) != recount.get(doc["id"], 0)
+        ]
+        if operations:
+            await db.products.bulk_write(operations, ordered=False)
+            logger.info(f"🔄 Compteurs de favoris réconciliés: {len(operations)} annonces corrigées")
+
+favorite_counters = FavoriteCounters()
+background_jobs.append(every(float(os.environ.get('FAVORITE_COUNTERS_FLUSH_SECONDS', '5')), favorite_counters.flush))
+background_jobs.append(every(float(os.environ.get('FAVORITE_COUNTERS_RECONCILE_SECONDS', '3600')), favorite_counters.reconcile))
+shutdown_flushes.append(favorite_counters.flush)
+
+@on_product_change
+def remove_deleted_favorites(before, after):
+    """Drop the favorites of deleted products"""
+    if after is None:
+        spawn_background(db.favorites.delete_many({"product_id": before["id"]}))
+
+# Saved searches
+class IntervalTree:
+    """Static centered interval tree: which [low, high] intervals contain a point, in O(log n + matches)"""
+
+    def __init__(self, intervals: List[Tuple[float, float, str]]):
+        # Empty intervals match nothing, and could not be split around their own endpoints
+        self.root = self._build([interval for interval in intervals if interval[0] <= interval[1]])
+
+    @classmethod
+    def _build(cls, intervals):
+        if not intervals:
+            return None
+        endpoints = sorted(bound for low, high, _ in intervals for bound in (low, high) if math.isfinite(bound))
+        center = endpoints[len(endpoints) // 2] if endpoints else 0.0
+        left = [interval for interval in intervals if interval[1] < center]
+        right = [interval for interval in intervals if interval[0] > center]
+        overlapping = [interval for interval in intervals if interval[0] <= center <= interval[1]]
+        return (
+            center,
+            sorted(overlapping, key=lambda interval: interval[0]),
+            sorted(overlapping, key=lambda interval: interval[1], reverse=True),
+            cls._build(left),
+            cls._build(right),
+        )
+
+    def stab(self, point: float) -> List[str]:
+        matches = []
+        node = self.root
+        while node is not None:
+            center, by_low, by_high, left, right = node
+            if point < center:
+                # Every interval here ends at or after the center, so only the start matters
+                matches.extend(key for _, _, key in itertools.takewhile(lambda interval: interval[0] <= point, by_low))
+                node = left
+            else:
+                matches.extend(key for _, _, key in itertools.takewhile(lambda interval: interval[1] >= point, by_high))
+                node = right if point > center else None
+        return matches
+
+def saved_search_key(category: Any, game_name: Optional[str], location: Any) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    return (
+        coded_value(category) if category else None,
+        normalize_text(game_name).strip() if game_name else None,
+        coded_value(location) if location else None,
+    )
+
+class SavedSearchIndex:
+    """Saved searches indexed by their predicates, so a product is matched without scanning them all.
 
-class UserLogin(BaseModel):
-    email: str
-    password: str
+    Each search sits in the bucket of its (category, game, location) key, None
+    standing for "any". A product probes the eight buckets its own values or the
+    wildcards can reach, and each bucket's interval tree returns the searches whose
+    price range contains the product's price. A bucket's tree is rebuilt on the
+    first match after it changes.
+    """
 
-class UserUpdate(BaseModel):
-    username: Optional[str] = None
-    email: Optional[str] = None
-    display_name: Optional[str] = None
-    bio: Optional[str] = None
-    location_display: Optional[str] = None
-    avatar: Optional[str] = None
-    location: Optional[LocationRegion] = None
+    def __init__(self):
+        self.searches: Dict[str, Dict[str, Any]] = {}
+        self.buckets: Dict[Tuple, Dict[str, Tuple[float, float]]] = {}
+        self.trees: Dict[Tuple, IntervalTree] = {}
 
-# Session Models
-class UserSession(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    user_id: str
-    token: str
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    expires_at: datetime
-    is_active: bool = True
+    def add(self, search: Dict[str, Any]):
+        self.remove(search["id"])
+        key = saved_search_key(search.get("category"), search.get("game_name"), search.get("location"))
+        low = search.get("min_price")
+        high = search.get("max_price")
+        self.searches[search["id"]] = {"id": search["id"], "user_id": search["user_id"], "key": key}
+        self.buckets.setdefault(key, {})[search["id"]] = (
+            -math.inf if low is None else low,
+            math.inf if high is None else high,
+        )
+        self.trees.pop(key, None)
 
-class AuthResponse(BaseModel):
-    user: User
-    token: str
-    expires_at: datetime
+    def remove(self, search_id: str):
+        search = self.searches.pop(search_id, None)
+        if search is None:
+            return
+        bucket = self.buckets[search["key"]]
+        del bucket[search_id]
+        if not bucket:
+            del self.buckets[search["key"]]
+        self.trees.pop(search["key"], None)
 
-async def get_current_user(token: str = None) -> User:
-    """Get current user from session token"""
-    if not token:
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    # Find active session
-    session = await db.sessions.find_one({
-        "token": token, 
-        "is_active": True,
-        "expires_at": {"$gt": datetime.utcnow()}
-    })
-    
-    if not session:
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-    
-    # Get user
-    user = await db.users.find_one({"id": session["user_id"]})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    return User(**user)
+    def match(self, product: Dict[str, Any]) -> List[Dict[str, Any]]:
+        price = product.get("price")
+        if price is None:
+            return []
+        category, game, location = saved_search_key(product.get("category"), product.get("game_name"), product.get("location"))
+        matches = []
+        for key in itertools.product((category, None), (game, None), (location, None)):
+            bucket = self.buckets.get(key)
+            if not bucket:
+                continue
+            tree = self.trees.get(key)
+            if tree is None:
+                tree = self.trees[key] = IntervalTree([(low, high, search_id) for search_id, (low, high) in bucket.items()])
+            matches.extend(self.searches[search_id] for search_id in tree.stab(price))
+        return matches
 
-# Review Models
-class Review(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    product_id: str
-    reviewer_id: str
-    reviewer_username: str
-    rating: int  # 1-5 stars
-    comment: str
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    is_verified_purchase: bool = False
+    async def load(self):
+        """Replace the index with the stored searches (picks up searches saved on other workers)"""
+        searches = await db.saved_searches.find({}, {"_id": 0, "name": 0, "created_at": 0}).to_list(None)
+        index = SavedSearchIndex()
+        for search in searches:
+            index.add(search)
+        self.searches, self.buckets, self.trees = index.searches, index.buckets, index.trees
 
-class ReviewCreate(BaseModel):
-    product_id: str
-    reviewer_id: str
-    reviewer_username: str
-    rating: int
-    comment: str
-    is_verified_purchase: bool = False
+MAX_SAVED_SEARCHES_PER_USER = int(os.environ.get('MAX_SAVED_SEARCHES_PER_USER', '20'))
+saved_search_index = SavedSearchIndex()
+startup_hooks.append(saved_search_index.load)
+background_jobs.append(every(float(os.environ.get('SAVED_SEARCH_RELOAD_SECONDS', '60')), saved_search_index.load))
 
-# Market Data Models
-class PriceHistory(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    product_id: str
-    price: float
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+# Matches are queued in the notification_outbox collection and delivered to the users'
+# notifications by a background job, so neither step adds work to the product write.
+notification_outbox = BufferedWriter(
+    "notification_outbox",
+    flush_interval=float(os.environ.get('NOTIFICATION_OUTBOX_FLUSH_SECONDS', '2')),
+)
+background_jobs.append(notification_outbox.run)
+shutdown_flushes.append(notification_outbox.flush)
 
-class MarketStats(BaseModel):
-    total_products: int
-    total_sales: int
-    average_price: float
-    trending_games: List[str]
-    featured_products: List[GameProduct]
+@on_product_change
+def queue_saved_search_alerts(before, after):
+    """Queue a notification for every saved search matching a new listing or a price drop"""
+    if after is None or not after.get("is_available", True):
+        return
+    if before is None or not before.get("is_available", True):
+        kind, previous_price = "new_listing", None
+    elif after.get("price") is not None and before.get("price") is not None and after["price"] < before["price"]:
+        kind, previous_price = "price_drop", before["price"]
+    else:
+        return
+    # One notification per user, however many of their searches match
+    notified = {after.get("seller_id")}
+    for search in saved_search_index.match(after):
+        if search["user_id"] in notified:
+            continue
+        notified.add(search["user_id"])
+        notification_outbox.add(Notification(
+            user_id=search["user_id"], kind=kind, saved_search_id=search["id"], product_id=after["id"],
+            title=after.get("title", ""), price=after["price"], previous_price=previous_price
+        ).dict())
 
-# Models pour l'authentification sociale
-class SocialAuthRequest(BaseModel):
-    token: str
-    provider: str  # "google" ou "apple"
+async def deliver_notifications(batch_size: int = 500):
+    """Move queued notifications from the outbox to the users' notifications.
 
-# Legacy models for compatibility
-class StatusCheck(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    client_name: str
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    Notification ids are unique, so an entry delivered twice (another worker, or a
+    crash before the outbox cleanup) is only stored once.
+    """
+    while True:
+        entries = await db.notification_outbox.find({}, {"_id": 0}).sort("created_at", 1).limit(batch_size).to_list(None)
+        if not entries:
+            return
+        try:
+            await db.notifications.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        await db.notification_outbox.delete_many({"id": {"$in": [entry["id"] for entry in entries]}})
+        if len(entries) < batch_size:
+            return
 
-class StatusCheckCreate(BaseModel):
-    client_name: str
+background_jobs.append(every(float(os.environ.get('NOTIFICATION_DELIVERY_SECONDS', '5')), deliver_notifications))
 
-# Stripe Payment Models
-class PaymentRequest(BaseModel):
-    product_id: str
-    success_url: str
-    cancel_url: str
+# Sales counters
+# Documents of the sales_counters collection: one market-wide, one per seller and one per game
+MARKET_SALES_KEY = "market"
+
+def seller_sales_key(seller_id: str) -> str:
+    return f"seller:{seller_id}"
+
+def game_sales_key(game_name: str) -> str:
+    return f"game:{game_name}"
+
+async def record_sale(order: Order):
+    """Count a new order in the market, seller and game counters (one batch) and on both users"""
+    increment = {"$inc": {"count": 1, "revenue": order.amount}}
+    keys = [MARKET_SALES_KEY, game_sales_key(order.game_name)]
+    user_updates = []
+    if order.seller_id:
+        keys.append(seller_sales_key(order.seller_id))
+        user_updates.append(UpdateOne({"id": order.seller_id}, {"$inc": {"total_sales": 1}}))
+    else:
+        # The listing was gone when the payment was confirmed: the sale still counts for the market and the game
+        logger.warning(f"⚠️ Commande {order.id} sans vendeur, compteur vendeur ignoré")
+    if order.buyer_id:
+        user_updates.append(UpdateOne({"id": order.buyer_id}, {"$inc": {"total_purchases": 1}}))
+    writes = [db.sales_counters.bulk_write([UpdateOne({"_id": key}, increment, upsert=True) for key in keys], ordered=False)]
+    if user_updates:
+        writes.append(db.users.bulk_write(user_updates, ordered=False))
+    await asyncio.gather(*writes)
+
+async def reconcile_sales_counters():
+    """Recount the sales counters and user totals from the orders ledger to repair drift"""
+    pipeline = [{"$facet": {
+        "market": [{"$group": {"_id": None, "count": {"$sum": 1}, "revenue": {"$sum": "$amount"}}}],
+        "sellers": [{"$group": {"_id": "$seller_id", "count": {"$sum": 1}, "revenue": {"$sum": "$amount"}}}],
+        "games": [{"$group": {"_id": "$game_name", "count": {"$sum": 1}, "revenue": {"$sum": "$amount"}}}],
+        "buyers": [{"$match": {"buyer_id": {"$ne": None}}}, {"$group": {"_id": "$buyer_id", "count": {"$sum": 1}}}],
+    }}]
+    result = (await db.orders.aggregate(pipeline).to_list(None))[0]
+    # Orders without a seller (listing deleted before the payment) have no seller counter
+    sellers = [doc for doc in result["sellers"] if doc["_id"]]
+    counters = [(MARKET_SALES_KEY, doc) for doc in result["market"]]
+    counters += [(seller_sales_key(doc["_id"]), doc) for doc in sellers]
+    counters += [(game_sales_key(doc["_id"]), doc) for doc in result["games"]]
+    if not counters:
+        return
+    
+    await db.sales_counters.bulk_write([
+        UpdateOne({"_id": key}, {"$set": {"count": doc["count"], "revenue": doc["revenue"]}}, upsert=True)
+        for key, doc in counters
+    ], ordered=False)
+    user_updates = [UpdateOne({"id": doc["_id"]}, {"$set": {"total_sales": doc["count"]}}) for doc in sellers]
+    user_updates += [UpdateOne({"id": doc["_id"]}, {"$set": {"total_purchases": doc["count"]}}) for doc in result["buyers"]]
+    if user_updates:
+        await db.users.bulk_write(user_updates, ordered=False)
+    logger.info(f"🔄 Compteurs de ventes réconciliés: {len(counters)} compteurs")
+
+background_jobs.append(every(float(os.environ.get('SALES_COUNTERS_RECONCILE_SECONDS', '3600')), reconcile_sales_counters))
+
+# Conditional GET helpers
+# Per-route Cache-Control policies for public read endpoints
+CACHE_POLICIES = {
+    "categories": "public, max-age=86400",
+    "games": "public, max-age=60",
+    "market_stats": "public, max-age=30, stale-while-revalidate=30",
+    # Views are counted server-side, so clients must revalidate every time
+    "product": "public, no-cache",
+    "reviews": "public, max-age=60",
+    "price_insight": "public, max-age=60",
+    "autocomplete": "public, max-age=60",
+}
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison of `etag` against the If-None-Match request header"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+def conditional_json_response(request: Request, content: Any, cache_policy: str, etag: Optional[str] = None) -> Response:
+    """Serialize `content`, answering 304 when the client already holds the same representation.
+
+    Without an explicit (weak) `etag`, a strong one is derived from the response body.
+    """
+    headers = {"Cache-Control": CACHE_POLICIES[cache_policy]}
+    response = None
+    if etag is None:
+        response = JSONResponse(content=jsonable_encoder(content), headers=headers)
+        etag = f'"{hashlib.sha1(response.body).hexdigest()}"'
+    headers["ETag"] = etag
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if response is None:
+        return JSONResponse(content=jsonable_encoder(content), headers=headers)
+    response.headers["ETag"] = etag
+    return response
 
 # Basic routes
 @api_router.get("/")
@@ -369,11 +2899,12 @@ async def get_status_checks():
 async def create_product(product: GameProductCreate):
     product_dict = product.dict()
     product_obj = GameProduct(**product_dict)
-    await db.products.insert_one(product_obj.dict())
+    product_doc = product_obj.dict()
+    await db.products.insert_one(product_doc)
+    notify_product_change(None, product_doc)
     return product_obj
 
-@api_router.get("/products", response_model=List[GameProduct])
-async def get_products(
+def build_product_filters(
     category: Optional[ProductCategory] = None,
     game_name: Optional[str] = None,
     location: Optional[LocationRegion] = None,
@@ -381,10 +2912,9 @@ async def get_products(
     max_price: Optional[float] = None,
     condition: Optional[ProductCondition] = None,
     search: Optional[str] = None,
-    featured_only: bool = False,
-    skip: int = 0,
-    limit: int = 20
-):
+    featured_only: bool = False
+) -> Dict[str, Any]:
+    """Translate the product browsing parameters into a Mongo filter"""
     filters = {"is_available": True}
     
     if category:
@@ -411,106 +2941,471 @@ async def get_products(
     if featured_only:
         filters["is_featured"] = True
     
-    products = await db.products.find(filters).skip(skip).limit(limit).sort("created_at", -1).to_list(None)
-    return [GameProduct(**product) for product in products]
+    return filters
+
+# Upper bounds of the price facet buckets; anything above the last one lands in the open-ended bucket
+PRICE_FACET_BOUNDARIES = [0, 25, 50, 100, 250, 500, 1000]
+facet_cache = TTLCache(ttl=float(os.environ.get('FACET_CACHE_SECONDS', '30')), max_entries=2048)
+
+def facet_cache_key(filters: Dict[str, Any]) -> str:
+    # Enum members and nested operators serialize deterministically once keys are sorted
+    return json.dumps(filters, sort_keys=True, default=str)
+
+async def get_product_facets(filters: Dict[str, Any]) -> ProductFacets:
+    """Count products per category, location, condition and price bucket in one aggregation"""
+    cache_key = facet_cache_key(filters)
+    cached = facet_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    top_boundary = PRICE_FACET_BOUNDARIES[-1]
+    pipeline = [
+        # Only this stage can use an index, so it carries the whole filter
+        {"$match": filters},
+        {"$project": {"_id": 0, "category": 1, "location": 1, "condition": 1, "price": 1}},
+        {"$facet": {
+            "category": [{"$sortByCount": "$category"}],
+            "location": [{"$sortByCount": "$location"}],
+            "condition": [{"$sortByCount": "$condition"}],
+            "price": [{"$bucket": {
+                "groupBy": "$price",
+                "boundaries": PRICE_FACET_BOUNDARIES,
+                "default": top_boundary,
+                "output": {"count": {"$sum": 1}}
+            }}]
+        }}
+    ]
+    result = (await db.products.aggregate(pipeline).to_list(None))[0]
+    
+    bucket_counts = {bucket["_id"]: bucket["count"] for bucket in result["price"]}
+    bounds = PRICE_FACET_BOUNDARIES + [None]
+    facets = ProductFacets(
+        category=[FacetCount(value=item["_id"], count=item["count"]) for item in result["category"]],
+        location=[FacetCount(value=item["_id"], count=item["count"]) for item in result["location"]],
+        condition=[FacetCount(value=item["_id"], count=item["count"]) for item in result["condition"]],
+        price=[
+            PriceBucketCount(min=lower, max=upper, count=bucket_counts[lower])
+            for lower, upper in zip(bounds, bounds[1:]) if lower in bucket_counts
+        ]
+    )
+    facet_cache.set(cache_key, facets)
+    return facets
+
+# Columnar catalog
+# CATALOG_ENGINE=columnar answers product listings without regex filters from an in-memory
+# snapshot of the available products; "mongo" (default) always queries the database.
+CATALOG_ENGINE = os.environ.get('CATALOG_ENGINE', 'mongo')
+CATALOG_CODED_FIELDS = ("category", "location", "condition")
+CATALOG_PROJECTION = {"_id": 0, "id": 1, "price": 1, "is_featured": 1, "created_at": 1, **{field: 1 for field in CATALOG_CODED_FIELDS}}
+# Filters the snapshot evaluates itself; anything else (game_name and search regexes) goes to Mongo
+CATALOG_FILTERS = {"is_available", "price", "is_featured", *CATALOG_CODED_FIELDS}
+
+def coded_value(value: Any) -> str:
+    return str(getattr(value, "value", value))
+
+class CatalogSnapshot:
+    """Available products as NumPy columns, filtered with vectorized masks.
+
+    Category, location and condition are stored as integer codes, created_at as
+    int64 microseconds. A listing page is the ids of the newest matching rows;
+    the documents themselves come from the product cache. Product writes update
+    the columns in place (sold or deleted rows are masked out) and a periodic
+    rebuild from Mongo compacts them and picks up writes made by other workers.
+    """
+
+    def __init__(self, refresh_seconds: float = 300):
+        self.refresh_seconds = refresh_seconds
+        self.ready = False
+        self.built_at = 0.0
+        self._rebuilding = False
+        self._replay: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]] = []
+        self._load(self._build([]))
+
+    # Building
+    @staticmethod
+    def _build(products: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Turn `products` into a fresh set of columns (CPU only, safe to run in a thread)"""
+        vocabularies: Dict[str, Dict[str, int]] = {field: {} for field in CATALOG_CODED_FIELDS}
+        columns = {
+            field: np.fromiter(
+                (vocabulary.setdefault(coded_value(product.get(field)), len(vocabulary)) for product in products),
+                dtype=np.int32, count=len(products)
+            )
+            for field, vocabulary in vocabularies.items()
+        }
+        columns["price"] = np.array([product.get("price", np.nan) for product in products], dtype=np.float64)
+        columns["is_featured"] = np.array([bool(product.get("is_featured")) for product in products], dtype=bool)
+        columns["created_at"] = np.array([product.get("created_at") for product in products], dtype="datetime64[us]").astype(np.int64)
+        columns["alive"] = np.ones(len(products), dtype=bool)
+        ids = np.empty(len(products), dtype=object)
+        ids[:] = [product["id"] for product in products]
+        return {"vocabularies": vocabularies, "columns": columns, "ids": ids}
+
+    def _load(self, state: Dict[str, Any]):
+        self.vocabularies = state["vocabularies"]
+        self.columns = state["columns"]
+        self.ids = state["ids"]
+        self.size = len(self.ids)
+        self.rows = {product_id: row for row, product_id in enumerate(self.ids.tolist())}
+        self.dead = 0
+
+    async def rebuild(self):
+        self._rebuilding = True
+        try:
+            products = await db.products.find({"is_available": True}, CATALOG_PROJECTION).to_list(None)
+            state = await asyncio.to_thread(self._build, products)
+            self._load(state)
+        finally:
+            self._rebuilding = False
+            replay, self._replay = self._replay, []
+        # Apply the writes that happened while the build was running (harmless if already in the snapshot)
+        for before, after in replay:
+            self.apply(before, after)
+        self.ready = True
+        self.built_at = time.monotonic()
+        logger.info(f"🗃️ Catalogue en colonnes reconstruit: {self.size} annonces")
+
+    async def run(self, interval: float = 10):
+        """Build at startup, then rebuild when the snapshot is old or mostly dead rows (or the last build failed)"""
+        while True:
+            if (not self.ready or time.monotonic() - self.built_at >= self.refresh_seconds
+                    or self.dead > max(1000, self.size // 4)):
+                try:
+                    await self.rebuild()
+                except Exception as e:
+                    logger.error(f"❌ Erreur de construction du catalogue en colonnes: {e}")
+            await asyncio.sleep(interval)
+
+    # Incremental updates
+    def apply(self, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+        if self._rebuilding:
+            self._replay.append((before, after))
+        product_id = (after or before)["id"]
+        if after is None or not after.get("is_available", True):
+            self.remove(product_id)
+        else:
+            self.upsert(after)
+
+    def upsert(self, product: Dict[str, Any]):
+        row = self.rows.get(product["id"])
+        if row is None:
+            row = self.size
+            if row == len(self.ids):
+                grow = max(1024, len(self.ids) // 2)
+                self.columns = {name: np.concatenate((column, np.zeros(grow, dtype=column.dtype))) for name, column in self.columns.items()}
+                self.ids = np.concatenate((self.ids, np.empty(grow, dtype=object)))
+            self.ids[row] = product["id"]
+            self.rows[product["id"]] = row
+            self.size += 1
+        for field, vocabulary in self.vocabularies.items():
+            self.columns[field][row] = vocabulary.setdefault(coded_value(product.get(field)), len(vocabulary))
+        self.columns["price"][row] = product.get("price", np.nan)
+        self.columns["is_featured"][row] = bool(product.get("is_featured"))
+        self.columns["created_at"][row] = np.datetime64(product.get("created_at"), "us").astype(np.int64)
+        self.columns["alive"][row] = True
+
+    def remove(self, product_id: str):
+        row = self.rows.pop(product_id, None)
+        if row is not None:
+            self.columns["alive"][row] = False
+            self.dead += 1
+
+    # Querying
+    def serves(self, filters: Dict[str, Any]) -> bool:
+        return self.ready and filters.get("is_available") is True and set(filters) <= CATALOG_FILTERS
+
+    def mask(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Rows matching a filter from build_product_filters (only the CATALOG_FILTERS kinds)"""
+        columns = {name: column[:self.size] for name, column in self.columns.items()}
+        mask = columns["alive"].copy()
+        for field in CATALOG_CODED_FIELDS:
+            if field in filters:
+                code = self.vocabularies[field].get(coded_value(filters[field]))
+                if code is None:
+                    return np.zeros(self.size, dtype=bool)
+                mask &= columns[field] == code
+        price = filters.get("price", {})
+        if "$gte" in price:
+            mask &= columns["price"] >= price["$gte"]
+        if "$lte" in price:
+            mask &= columns["price"] <= price["$lte"]
+        if filters.get("is_featured"):
+            mask &= columns["is_featured"]
+        return mask
+
+    def page(self, mask: np.ndarray, skip: int, limit: int) -> List[str]:
+        """Ids of the matching rows ranked skip..skip+limit by created_at, newest first"""
+        rows = np.flatnonzero(mask)
+        created_at = self.columns["created_at"]
+        wanted = skip + limit
+        if len(rows) > wanted:
+            rows = rows[np.argpartition(-created_at[rows], wanted - 1)[:wanted]]
+        rows = rows[np.argsort(-created_at[rows], kind="stable")]
+        return self.ids[rows[skip:wanted]].tolist()
+
+    def facets(self, mask: np.ndarray) -> ProductFacets:
+        """Same counts as get_product_facets, from the masked columns"""
+        counts = {}
+        for field, vocabulary in self.vocabularies.items():
+            values = list(vocabulary)
+            per_code = np.bincount(self.columns[field][:self.size][mask], minlength=len(values))
+            counts[field] = [
+                FacetCount(value=values[code], count=int(per_code[code]))
+                for code in np.argsort(-per_code, kind="stable").tolist() if per_code[code]
+            ]
+        # Bucket by lower bound; negative, missing and prices past the last boundary land in the open-ended bucket
+        buckets = np.searchsorted(PRICE_FACET_BOUNDARIES, self.columns["price"][:self.size][mask], side="right") - 1
+        buckets[buckets < 0] = len(PRICE_FACET_BOUNDARIES) - 1
+        per_bucket = np.bincount(buckets, minlength=len(PRICE_FACET_BOUNDARIES))
+        bounds = PRICE_FACET_BOUNDARIES + [None]
+        return ProductFacets(
+            **counts,
+            price=[
+                PriceBucketCount(min=lower, max=upper, count=int(count))
+                for lower, upper, count in zip(bounds, bounds[1:], per_bucket.tolist()) if count
+            ]
+        )
+
+def apply_relayed_product_event(payload: Dict[str, Any]):
+    catalog_snapshot.apply(payload["before"], payload["after"])
+
+
+catalog_snapshot = CatalogSnapshot(refresh_seconds=float(os.environ.get('CATALOG_REFRESH_SECONDS', '300')))
+if CATALOG_ENGINE == 'columnar':
+    background_jobs.append(catalog_snapshot.run)
+
+    @on_product_change
+    def update_catalog_snapshot(before, after):
+        """Mirror listing, price and availability changes into the columnar catalog"""
+        catalog_snapshot.apply(before, after)
+
+    # Writes handled by the other workers (needs REDIS_URL; the periodic rebuild covers the rest)
+    invalidation_bus.on_event("product_event", apply_relayed_product_event)
+
+async def list_products_from_snapshot(filters: Dict[str, Any], skip: int, limit: int, include_facets: bool,
+                                      attempts: int = 3) -> Union[List[GameProduct], ProductPage]:
+    matches = compile_product_filter(filters)
+    for _ in range(attempts):
+        mask = catalog_snapshot.mask(filters)
+        page_ids = catalog_snapshot.page(mask, skip, limit)
+        documents = await get_products_by_ids(page_ids)
+        # The snapshot can lag behind writes made elsewhere: correct it from the documents and cut the page again
+        stale = [product_id for product_id in page_ids if product_id not in documents or not matches(documents[product_id])]
+        for product_id in stale:
+            document = documents.get(product_id)
+            catalog_snapshot.apply({"id": product_id}, document)
+        if not stale:
+            break
+    facets = catalog_snapshot.facets(mask) if include_facets else None
+    # Whatever is still stale after the last attempt is left out rather than shown
+    products = [GameProduct(**documents[product_id]) for product_id in page_ids if product_id not in stale]
+    if not include_facets:
+        return products
+    return ProductPage(products=products, facets=facets)
+
+@api_router.get("/products", response_model=Union[List[GameProduct], ProductPage])
+async def get_products(
+    category: Optional[ProductCategory] = None,
+    game_name: Optional[str] = None,
+    location: Optional[LocationRegion] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    condition: Optional[ProductCondition] = None,
+    search: Optional[str] = None,
+    featured_only: bool = False,
+    skip: int = 0,
+    limit: int = 20,
+    include_facets: bool = False
+):
+    filters = build_product_filters(
+        category, game_name, location, min_price, max_price, condition, search, featured_only
+    )
+    # Identical concurrent listings (e.g. the homepage under a spike) share one query
+    key = (json.dumps(jsonable_encoder(filters), sort_keys=True), skip, limit, include_facets)
+    return await products_flight.do(key, lambda: list_products(filters, skip, limit, include_facets))
+
+products_flight = SingleFlight("products")
+
+async def list_products(filters: Dict[str, Any], skip: int, limit: int, include_facets: bool) -> Union[List[GameProduct], ProductPage]:
+    if CATALOG_ENGINE == 'columnar' and limit > 0 and skip >= 0 and catalog_snapshot.serves(filters):
+        return await list_products_from_snapshot(filters, skip, limit, include_facets)
+    products_query = db.products.find(filters).skip(skip).limit(limit).sort("created_at", -1).to_list(None)
+    if not include_facets:
+        products = await products_query
+        return [GameProduct(**product) for product in products]
+    
+    products, facets = await asyncio.gather(products_query, get_product_facets(filters))
+    return ProductPage(products=[GameProduct(**product) for product in products], facets=facets)
 
 @api_router.get("/products/{product_id}", response_model=GameProduct)
-async def get_product(product_id: str):
-    product = await db.products.find_one({"id": product_id})
+async def get_product(product_id: str, request: Request):
+    # Increment view count and read the product in one round trip
+    # (a view is not a content change, so updated_at and version are left alone)
+    product = await db.products.find_one_and_update(
+        {"id": product_id},
+        {"$inc": {"view_count": 1}},
+        return_document=ReturnDocument.AFTER
+    )
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    # Increment view count
-    await db.products.update_one(
-        {"id": product_id},
-        {"$inc": {"view_count": 1}, "$set": {"updated_at": datetime.utcnow()}}
-    )
+    product["favorite_count"] = product.get("favorite_count", 0) + favorite_counters.pending(product_id)
     
-    return GameProduct(**product)
+    # Weak validator: the listing content is unchanged as long as its version is, even if view_count moved.
+    # favorite_count is shown on the page but does not bump the version, so it is part of the tag.
+    etag = (
+        f'W/"{product_id}-{product.get("version", 0)}-{product["updated_at"].isoformat()}'
+        f'-{product["favorite_count"]}"'
+    )
+    return conditional_json_response(request, GameProduct(**product), "product", etag=etag)
+
+def version_filter(version: int) -> Dict[str, Any]:
+    """Match documents at `version`; documents written before versioning count as version 0"""
+    if version == 0:
+        return {"version": {"$in": [0, None]}}
+    return {"version": version}
 
 @api_router.put("/products/{product_id}", response_model=GameProduct)
 async def update_product(product_id: str, product_update: GameProductUpdate):
-    update_data = {k: v for k, v in product_update.dict().items() if v is not None}
+    update_data = {k: v for k, v in product_update.dict(exclude={"expected_version"}).items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    result = await db.products.update_one({"id": product_id}, {"$set": update_data})
-    if result.matched_count == 0:
+    query = {"id": product_id}
+    if product_update.expected_version is not None:
+        query.update(version_filter(product_update.expected_version))
+    
+    # The pre-image is what the product hooks need (price/availability changes); the
+    # update is a plain $set plus the version bump, so the post-image is derived
+    # locally from it instead of re-reading the document.
+    previous_product = await db.products.find_one_and_update(
+        query,
+        {"$set": update_data, "$inc": {"version": 1}},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not previous_product:
+        # Only the failure path pays for a second read, to tell a stale version from a missing product
+        if product_update.expected_version is not None and await db.products.count_documents({"id": product_id}, limit=1):
+            raise HTTPException(status_code=409, detail="Product was modified concurrently")
         raise HTTPException(status_code=404, detail="Product not found")
     
-    updated_product = await db.products.find_one({"id": product_id})
+    updated_product = {**previous_product, **update_data, "version": previous_product.get("version", 0) + 1}
+    notify_product_change(previous_product, updated_product)
     return GameProduct(**updated_product)
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str):
-    result = await db.products.delete_one({"id": product_id})
-    if result.deleted_count == 0:
+    deleted_product = await db.products.find_one_and_delete({"id": product_id})
+    if not deleted_product:
         raise HTTPException(status_code=404, detail="Product not found")
+    notify_product_change(deleted_product, None)
     return {"message": "Product deleted successfully"}
 
+@api_router.get("/products/{product_id}/similar", response_model=List[SimilarListing])
+async def get_similar_products(product_id: str, limit: int = Query(8, ge=1, le=50)):
+    """Listings closest to `product_id`, served from the in-memory index (empty until it is built)"""
+    return similarity_index.similar([product_id], k=limit).get(product_id, [])
+
+# Live feed
+@api_router.get("/feed/products")
+async def product_feed(
+    request: Request,
+    category: Optional[ProductCategory] = None,
+    game_name: Optional[str] = None,
+    location: Optional[LocationRegion] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    condition: Optional[ProductCondition] = None,
+    search: Optional[str] = None,
+    featured_only: bool = False
+):
+    """Server-sent events for listings matching the get_products filters (created, price changes, sales, deletions)"""
+    if product_event_bus.subscriber_count >= FEED_MAX_SUBSCRIBERS:
+        raise HTTPException(status_code=503, detail="Too many live feed connections", headers={"Retry-After": "30"})
+    filters = build_product_filters(
+        category, game_name, location, min_price, max_price, condition, search, featured_only
+    )
+    if len(game_name or "") > FEED_MAX_SEARCH_LENGTH or len(search or "") > FEED_MAX_SEARCH_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Search text is limited to {FEED_MAX_SEARCH_LENGTH} characters")
+    subscription = product_event_bus.subscribe(filters, request.headers.get("last-event-id"))
+    
+    async def stream():
+        try:
+            yield f"retry: {int(FEED_HEARTBEAT_SECONDS * 1000)}\n\n".encode()
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscription.queue.get(), FEED_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing idle connections and detects dead clients
+                    yield FEED_HEARTBEAT
+        finally:
+            product_event_bus.unsubscribe(subscription)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
 # Categories and Games
 @api_router.get("/categories")
-async def get_categories():
-    return [{"value": cat.value, "label": cat.value.title()} for cat in ProductCategory]
+async def get_categories(request: Request):
+    categories = [{"value": cat.value, "label": cat.value.title()} for cat in ProductCategory]
+    return conditional_json_response(request, categories, "categories")
 
 @api_router.get("/games")
-async def get_popular_games():
-    pipeline = [
-        {"$group": {"_id": "$game_name", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 20}
-    ]
-    games = await db.products.aggregate(pipeline).to_list(None)
-    return [{"name": game["_id"], "product_count": game["count"]} for game in games]
+async def get_popular_games(request: Request):
+    # Served from the incrementally maintained counters (available listings only)
+    return conditional_json_response(request, game_counters.top(), "games")
+
+@api_router.get("/autocomplete", response_model=List[AutocompleteSuggestion])
+async def autocomplete(request: Request, q: str = Query(..., min_length=1, max_length=100), limit: int = Query(8, ge=1, le=20)):
+    """Typeahead suggestions for the search box, served from memory"""
+    return conditional_json_response(request, autocomplete_index.suggest(q, limit), "autocomplete")
 
 # Authentication Endpoints
 @api_router.post("/auth/register", response_model=AuthResponse)
-async def register_user(user_data: UserCreate):
+async def register_user(user_data: UserCreate, request: Request):
     """Register a new user"""
+    enforce_rate_limit("register", request, user_data.email)
     logger.info(f"📝 Tentative d'inscription: {user_data.username} ({user_data.email})")
     
-    # Check if user already exists
-    existing_user = await db.users.find_one({"email": user_data.email})
-    if existing_user:
-        logger.warning(f"❌ Email déjà enregistré: {user_data.email}")
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
-    existing_username = await db.users.find_one({"username": user_data.username})
-    if existing_username:
-        logger.warning(f"❌ Nom d'utilisateur déjà pris: {user_data.username}")
-        raise HTTPException(status_code=400, detail="Username already taken")
-    
     # Create user with hashed password
     user_dict = user_data.dict()
     password = user_dict.pop("password")
-    user_dict["password_hash"] = hash_password(password)
+    user_dict["password_hash"] = await password_hashing_gate.run(hash_password, password)
     
     logger.info(f"🔐 Mot de passe hashé pour: {user_data.username}")
     
     user_obj = User(**user_dict)
     
-    try:
-        result = await db.users.insert_one(user_obj.dict())
-        logger.info(f"✅ Utilisateur créé dans la DB: {result.inserted_id}")
-    except Exception as e:
-        logger.error(f"❌ Erreur lors de l'insertion en DB: {e}")
-        raise HTTPException(status_code=500, detail="Database error during user creation")
-    
-    # Create session
-    token = generate_session_token()
-    expires_at = datetime.utcnow().replace(microsecond=0) + timedelta(days=30)  # 30 day session
+    # Create session (a brand new user has no sessions to trim)
+    session = new_session(user_obj.id)
+    token = session.token
+    expires_at = session.expires_at
     
-    session = UserSession(
-        user_id=user_obj.id,
-        token=token,
-        expires_at=expires_at
+    # Email/username uniqueness is enforced by unique indexes, so the user and its
+    # session are written concurrently: one round trip instead of four sequential ones.
+    user_result, session_result = await asyncio.gather(
+        db.users.insert_one(user_obj.dict()),
+        store_session(session, trim=False),
+        return_exceptions=True
     )
     
-    try:
-        session_result = await db.sessions.insert_one(session.dict())
-        logger.info(f"✅ Session créée: {session_result.inserted_id}")
-    except Exception as e:
-        logger.error(f"❌ Erreur lors de la création de session: {e}")
+    if isinstance(user_result, Exception):
+        if not isinstance(session_result, Exception):
+            spawn_background(db.sessions.delete_one({"token": token}))
+        if isinstance(user_result, DuplicateKeyError):
+            field = duplicate_key_field(user_result)
+            if field in DUPLICATE_USER_ERRORS:
+                logger.warning(f"❌ {DUPLICATE_USER_ERRORS[field]}: {user_data.email} / {user_data.username}")
+                raise HTTPException(status_code=400, detail=DUPLICATE_USER_ERRORS[field])
+        logger.error(f"❌ Erreur lors de l'insertion en DB: {user_result}")
+        raise HTTPException(status_code=500, detail="Database error during user creation")
+    logger.info(f"✅ Utilisateur créé dans la DB: {user_result.inserted_id}")
+    
+    if isinstance(session_result, Exception):
+        logger.error(f"❌ Erreur lors de la création de session: {session_result}")
         raise HTTPException(status_code=500, detail="Database error during session creation")
+    logger.info(f"✅ Session créée: {session.id}")
     
     # Return user without password_hash
     user_dict = user_obj.dict()
@@ -526,8 +3421,9 @@ async def register_user(user_data: UserCreate):
     )
 
 @api_router.post("/auth/login", response_model=AuthResponse)
-async def login_user(login_data: UserLogin):
+async def login_user(login_data: UserLogin, request: Request):
     """Login user with email and password"""
+    enforce_rate_limit("login", request, login_data.email)
     logger.info(f"🔑 Tentative de connexion: {login_data.email}")
     
     user = await db.users.find_one({"email": login_data.email})
@@ -537,32 +3433,20 @@ async def login_user(login_data: UserLogin):
     
     logger.info(f"👤 Utilisateur trouvé: {user['username']}")
     
-    if not verify_password(login_data.password, user["password_hash"]):
+    if not await password_hashing_gate.run(verify_password, login_data.password, user["password_hash"]):
         logger.warning(f"❌ Mot de passe incorrect pour: {login_data.email}")
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     logger.info(f"✅ Mot de passe vérifié pour: {user['username']}")
     
-    # Deactivate old sessions
-    old_sessions_result = await db.sessions.update_many(
-        {"user_id": user["id"], "is_active": True},
-        {"$set": {"is_active": False}}
-    )
-    logger.info(f"🔄 Anciennes sessions désactivées: {old_sessions_result.modified_count}")
-    
-    # Create new session
-    token = generate_session_token()
-    expires_at = datetime.utcnow().replace(microsecond=0) + timedelta(days=30)  # 30 day session
-    
-    session = UserSession(
-        user_id=user["id"],
-        token=token,
-        expires_at=expires_at
-    )
+    # Create new session; the oldest ones beyond MAX_SESSIONS_PER_USER are removed
+    session = new_session(user["id"])
+    token = session.token
+    expires_at = session.expires_at
     
     try:
-        session_result = await db.sessions.insert_one(session.dict())
-        logger.info(f"✅ Nouvelle session créée: {session_result.inserted_id}")
+        await store_session(session)
+        logger.info(f"✅ Nouvelle session créée: {session.id}")
     except Exception as e:
         logger.error(f"❌ Erreur lors de la création de session: {e}")
         raise HTTPException(status_code=500, detail="Database error during session creation")
@@ -581,11 +3465,9 @@ async def login_user(login_data: UserLogin):
 
 @api_router.post("/auth/logout")
 async def logout_user(token: str):
-    """Logout user by deactivating session"""
-    await db.sessions.update_one(
-        {"token": token},
-        {"$set": {"is_active": False}}
-    )
+    """Logout user by deleting the session"""
+    await db.sessions.delete_one({"token": token})
+    await session_cache.invalidate(token)
     return {"message": "Successfully logged out"}
 
 @api_router.get("/auth/me", response_model=User)
@@ -597,6 +3479,34 @@ async def get_current_user_profile(token: str):
     user_dict["password_hash"] = "***"  # Hidden
     return User(**user_dict)
 
+async def create_social_user(name: str, email: str, attempts: int = 5) -> Dict[str, Any]:
+    """Insert a social login user, suffixing the username when another user already has it"""
+    base_username = name.lower().replace(" ", "_")
+    username = base_username
+    for _ in range(attempts):
+        user = User(
+            username=username,
+            email=email,
+            password_hash="",  # Pas de mot de passe pour connexion sociale
+            location=LocationRegion.FR,  # Default
+            display_name=name,
+            is_verified=True  # Vérifié car email validé par provider
+        ).dict()
+        try:
+            result = await db.users.insert_one(user)
+            logger.info(f"✅ Nouvel utilisateur social créé: {result.inserted_id}")
+            return user
+        except DuplicateKeyError as e:
+            if duplicate_key_field(e) == "email":
+                # Created meanwhile by a concurrent login with the same account
+                existing = await db.users.find_one({"email": email})
+                if existing:
+                    return existing
+                raise
+            username = f"{base_username}_{secrets.token_hex(3)}"
+    logger.error(f"❌ Aucun nom d'utilisateur libre pour: {name}")
+    raise HTTPException(status_code=500, detail="Database error")
+
 @api_router.post("/auth/social", response_model=AuthResponse)
 async def social_auth(auth_request: SocialAuthRequest):
     """Authentification via Google ou Apple"""
@@ -645,35 +3555,18 @@ async def social_auth(auth_request: SocialAuthRequest):
         # Créer un nouvel utilisateur si nécessaire
         if not user:
             logger.info(f"👤 Création d'un nouvel utilisateur social: {name}")
-            user = User(
-                username=name.lower().replace(" ", "_"),
-                email=email,
-                password_hash="",  # Pas de mot de passe pour connexion sociale
-                location=LocationRegion.FR,  # Default
-                display_name=name,
-                is_verified=True  # Vérifié car email validé par provider
-            )
-            try:
-                result = await db.users.insert_one(user.dict())
-                logger.info(f"✅ Nouvel utilisateur social créé: {result.inserted_id}")
-            except Exception as e:
-                logger.error(f"❌ Erreur création utilisateur social: {e}")
-                raise HTTPException(status_code=500, detail="Database error")
+            user = await create_social_user(name, email)
         
         # Créer une session
-        token = generate_session_token()
-        expires_at = datetime.utcnow() + timedelta(days=30)
-        
-        session = UserSession(
-            user_id=user["id"],
-            token=token,
-            expires_at=expires_at
-        )
+        session = new_session(user["id"])
+        token = session.token
+        expires_at = session.expires_at
         
-        await db.sessions.insert_one(session.dict())
+        await store_session(session)
         logger.info(f"✅ Session créée pour {auth_request.provider}: {user['username']}")
         
         # Retourner la réponse
+        user.pop("password_hash", None)
         return AuthResponse(
             user=User(**user, password_hash="***"),
             token=token,
@@ -695,39 +3588,29 @@ async def update_user_profile(token: str, user_update: UserUpdate):
         if value is not None:
             update_data[field] = value
     
-    if update_data:
-        # Check if username is being updated and is unique
-        if "username" in update_data:
-            existing = await db.users.find_one({
-                "username": update_data["username"],
-                "id": {"$ne": current_user.id}
-            })
-            if existing:
-                raise HTTPException(status_code=400, detail="Username already taken")
-        
-        # Check if email is being updated and is unique
-        if "email" in update_data:
-            existing = await db.users.find_one({
-                "email": update_data["email"],
-                "id": {"$ne": current_user.id}
-            })
-            if existing:
-                raise HTTPException(status_code=400, detail="Email already registered")
-        
-        await db.users.update_one(
+    if not update_data:
+        return User(**current_user.dict(exclude={"password_hash"}), password_hash="***")
+    
+    # Username/email uniqueness is enforced by the unique indexes on users
+    try:
+        updated_user = await db.users.find_one_and_update(
             {"id": current_user.id},
-            {"$set": update_data}
+            {"$set": update_data},
+            projection={"password_hash": 0},
+            return_document=ReturnDocument.AFTER
         )
+    except DuplicateKeyError as e:
+        field = duplicate_key_field(e)
+        raise HTTPException(status_code=400, detail=DUPLICATE_USER_ERRORS.get(field, "Duplicate value"))
+    if not updated_user:
+        raise HTTPException(status_code=404, detail="User not found")
     
-    # Return updated user
-    updated_user = await db.users.find_one({"id": current_user.id})
-    updated_user.pop("password_hash", None)
     return User(**updated_user, password_hash="***")
 
 @api_router.get("/sellers/{user_id}/profile")
 async def get_seller_profile(user_id: str):
     """Get seller profile with stats and products"""
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one({"id": user_id}, {"password_hash": 0})
     if not user:
         raise HTTPException(status_code=404, detail="Seller not found")
     
@@ -755,14 +3638,21 @@ async def get_seller_profile(user_id: str):
     avg_rating = rating_result[0]["avg_rating"] if rating_result and rating_result[0]["avg_rating"] else 0
     total_reviews = rating_result[0]["total_reviews"] if rating_result else 0
     
-    seller_profile = User(**user)
+    # Sales are read from the counter maintained by the Stripe webhook
+    sales = await db.sales_counters.find_one({"_id": seller_sales_key(user_id)}, {"count": 1}) or {}
+    
+    seller_profile = User(**user, password_hash="***")  # Hidden in response
+    seller_profile.total_sales = sales.get("count", seller_profile.total_sales)
+    seller_profile.last_seen = presence.last_seen(user_id, user.get("last_seen"))
+    seller_profile.is_online = presence.is_online(user_id, user.get("last_seen"))
     
     return {
         "seller": seller_profile.dict(),
         "stats": {
             "products_count": products_count,
             "average_rating": round(avg_rating, 1) if avg_rating else 0,
-            "total_reviews": total_reviews
+            "total_reviews": total_reviews,
+            "total_sales": seller_profile.total_sales
         }
     }
 
@@ -775,6 +3665,88 @@ async def get_seller_products(user_id: str, skip: int = 0, limit: int = 20):
     
     return [GameProduct(**product) for product in products]
 
+# Presence Endpoints
+@api_router.post("/presence/heartbeat")
+async def presence_heartbeat(token: str):
+    """Mark the user as online; clients call this periodically while the app is open"""
+    presence.beat(await session_user_id(token))
+    return {"online_for_seconds": PRESENCE_TTL_SECONDS}
+
+# Favorites Endpoints
+@api_router.post("/products/{product_id}/favorite")
+async def favorite_product(product_id: str, token: str):
+    """Add a product to the user's favorites (idempotent)"""
+    user_id = await session_user_id(token)
+    if not await db.products.count_documents({"id": product_id}, limit=1):
+        raise HTTPException(status_code=404, detail="Product not found")
+    try:
+        await db.favorites.insert_one(Favorite(user_id=user_id, product_id=product_id).dict())
+    except DuplicateKeyError:
+        return {"favorited": True}
+    favorite_counters.apply(product_id, 1)
+    return {"favorited": True}
+
+@api_router.delete("/products/{product_id}/favorite")
+async def unfavorite_product(product_id: str, token: str):
+    """Remove a product from the user's favorites (idempotent)"""
+    user_id = await session_user_id(token)
+    result = await db.favorites.delete_one({"user_id": user_id, "product_id": product_id})
+    if result.deleted_count:
+        favorite_counters.apply(product_id, -1)
+    return {"favorited": False}
+
+@api_router.get("/favorites", response_model=List[GameProduct])
+async def get_favorites(token: str, skip: int = 0, limit: int = Query(20, le=100)):
+    """The user's favorite products, most recently favorited first"""
+    user_id = await session_user_id(token)
+    favorites = await db.favorites.find(
+        {"user_id": user_id}, {"_id": 0, "product_id": 1}
+    ).sort("created_at", -1).skip(skip).limit(limit).to_list(None)
+    product_ids = [favorite["product_id"] for favorite in favorites]
+    products = await get_products_by_ids(product_ids)
+    return [GameProduct(**products[product_id]) for product_id in product_ids if product_id in products]
+
+# Saved Search Endpoints
+@api_router.post("/saved-searches", response_model=SavedSearch)
+async def create_saved_search(search: SavedSearchCreate, token: str):
+    """Save a search; new listings and price drops matching it are notified"""
+    user_id = await session_user_id(token)
+    if not any([search.category, search.game_name, search.location, search.max_price is not None]):
+        raise HTTPException(status_code=400, detail="A saved search needs a category, game, location or maximum price")
+    if search.min_price is not None and search.max_price is not None and search.min_price > search.max_price:
+        raise HTTPException(status_code=400, detail="min_price must not exceed max_price")
+    if await db.saved_searches.count_documents({"user_id": user_id}) >= MAX_SAVED_SEARCHES_PER_USER:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SAVED_SEARCHES_PER_USER} saved searches per user")
+    
+    saved_search = SavedSearch(**search.dict(), user_id=user_id)
+    await db.saved_searches.insert_one(saved_search.dict())
+    saved_search_index.add(saved_search.dict())
+    return saved_search
+
+@api_router.get("/saved-searches", response_model=List[SavedSearch])
+async def get_saved_searches(token: str):
+    user_id = await session_user_id(token)
+    searches = await db.saved_searches.find({"user_id": user_id}, {"_id": 0}).sort("created_at", -1).to_list(None)
+    return [SavedSearch(**search) for search in searches]
+
+@api_router.delete("/saved-searches/{search_id}")
+async def delete_saved_search(search_id: str, token: str):
+    user_id = await session_user_id(token)
+    result = await db.saved_searches.delete_one({"id": search_id, "user_id": user_id})
+    if not result.deleted_count:
+        raise HTTPException(status_code=404, detail="Saved search not found")
+    saved_search_index.remove(search_id)
+    return {"message": "Saved search deleted successfully"}
+
+@api_router.get("/notifications", response_model=List[Notification])
+async def get_notifications(token: str, skip: int = 0, limit: int = Query(20, le=100)):
+    """The user's saved search notifications, newest first"""
+    user_id = await session_user_id(token)
+    notifications = await db.notifications.find(
+        {"user_id": user_id}, {"_id": 0}
+    ).sort("created_at", -1).skip(skip).limit(limit).to_list(None)
+    return [Notification(**notification) for notification in notifications]
+
 # Review Endpoints
 @api_router.post("/reviews", response_model=Review)
 async def create_review(review: ReviewCreate):
@@ -784,9 +3756,9 @@ async def create_review(review: ReviewCreate):
     return review_obj
 
 @api_router.get("/products/{product_id}/reviews", response_model=List[Review])
-async def get_product_reviews(product_id: str):
+async def get_product_reviews(product_id: str, request: Request):
     reviews = await db.reviews.find({"product_id": product_id}).sort("created_at", -1).to_list(None)
-    return [Review(**review) for review in reviews]
+    return conditional_json_response(request, [Review(**review) for review in reviews], "reviews")
 
 @api_router.get("/products/{product_id}/reviews/stats")
 async def get_product_review_stats(product_id: str):
@@ -829,8 +3801,33 @@ async def get_price_history(product_id: str):
     history = await db.price_history.find({"product_id": product_id}).sort("timestamp", -1).limit(30).to_list(None)
     return [PriceHistory(**item) for item in history]
 
+@api_router.get("/products/{product_id}/price-insight", response_model=PriceInsight)
+async def get_price_insight(product_id: str, request: Request):
+    """Position of a listing's price within comparable listings (same game, category and condition)"""
+    listing = price_estimator.listings.get(product_id)
+    if listing is None:
+        # Sold or unlisted products are compared with the current market at their stored price
+        product = await db.products.find_one({"id": product_id}, PRICE_PROJECTION)
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        listing = (price_group(product), float(product["price"]))
+    insight = PriceInsight(**price_estimator.insight(product_id, *listing))
+    return conditional_json_response(request, insight, "price_insight")
+
+@api_router.get("/games/{game_name}/price-distribution", response_model=List[PriceGroupStats])
+async def get_game_price_distribution(game_name: str, request: Request):
+    """Price distribution of every (category, condition) group of a game, largest first"""
+    distribution = [PriceGroupStats(**stats) for stats in price_estimator.game_distribution(game_name)]
+    return conditional_json_response(request, distribution, "price_insight")
+
 @api_router.get("/market-stats", response_model=MarketStats)
-async def get_market_stats():
+async def get_market_stats(request: Request):
+    market_stats = await market_stats_flight.do("market-stats", compute_market_stats)
+    return conditional_json_response(request, market_stats, "market_stats")
+
+market_stats_flight = SingleFlight("market_stats")
+
+async def compute_market_stats() -> MarketStats:
     total_products = await db.products.count_documents({"is_available": True})
     
     # Get trending games
@@ -855,9 +3852,11 @@ async def get_market_stats():
     avg_price_result = await db.products.aggregate(pipeline).to_list(None)
     average_price = avg_price_result[0]["average_price"] if avg_price_result else 0
     
+    market_sales = await db.sales_counters.find_one({"_id": MARKET_SALES_KEY})
+    
     return MarketStats(
         total_products=total_products,
-        total_sales=0,  # To be implemented with order system
+        total_sales=market_sales["count"] if market_sales else 0,
         average_price=round(average_price, 2),
         trending_games=trending_games,
         featured_products=featured_products_obj
@@ -876,6 +3875,8 @@ async def create_checkout_session(payment_request: PaymentRequest):
             logger.error("Stripe API key not configured")
             raise HTTPException(status_code=500, detail="Configuration Stripe manquante")
         
+        buyer_id = await session_user_id(payment_request.token) if payment_request.token else None
+        
         # Récupérer le produit
         product = await db.products.find_one({"id": payment_request.product_id})
         if not product:
@@ -908,12 +3909,19 @@ async def create_checkout_session(payment_request: PaymentRequest):
                 'product_id': product['id'],
                 'product_title': product['title'],
                 'game_name': product['game_name'],
+                # Lets the webhook record the order without reading the product again
+                'seller_id': product['seller_id'],
+                'category': product['category'],
+                'buyer_id': buyer_id or '',
             }
         )
         
         logger.info(f"Checkout session created: {checkout_session.id}")
         return {"checkout_session_id": checkout_session.id, "url": checkout_session.url}
         
+    except HTTPException:
+        # 401 on a bad token, 404 on a missing product: keep the status
+        raise
     except stripe.error.StripeError as e:
         logger.error(f"Stripe error: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Erreur Stripe: {str(e)}")
@@ -941,18 +3949,66 @@ async def stripe_webhook(request: Request):
     if event['type'] == 'checkout.session.completed':
         session = event['data']['object']
         
+        metadata = session['metadata']
         # Ici vous pouvez envoyer l'email avec les détails du compte
         # ou traiter la commande
-        logger.info(f"Paiement réussi pour le produit {session['metadata']['product_id']}")
+        logger.info(f"Paiement réussi pour le produit {metadata['product_id']}")
         
-        # Marquer le produit comme vendu (optionnel)
-        await db.products.update_one(
-            {"id": session['metadata']['product_id']},
-            {"$set": {"is_available": False, "sold_at": datetime.utcnow()}}
+        if 'seller_id' not in metadata:
+            # Sessions created before the metadata carried the seller
+            product = await db.products.find_one(
+                {"id": metadata['product_id']}, {"_id": 0, "seller_id": 1, "category": 1, "game_name": 1}
+            ) or {}
+            metadata = {**product, **metadata}
+        amount_total = session.get('amount_total')
+        order = Order(
+            stripe_session_id=session['id'],
+            product_id=metadata['product_id'],
+            seller_id=metadata.get('seller_id', ''),
+            buyer_id=metadata.get('buyer_id') or None,
+            game_name=metadata.get('game_name', ''),
+            category=metadata.get('category', ''),
+            amount=amount_total / 100 if amount_total is not None else 0.0,
+            currency=session.get('currency') or "eur",
         )
+        try:
+            await db.orders.insert_one(order.dict())
+        except DuplicateKeyError:
+            # Redelivered event: finish what the previous delivery may have left undone
+            stored_order = await db.orders.find_one({"stripe_session_id": order.stripe_session_id}, {"_id": 0})
+            if stored_order:
+                # Orders stored before the completion flags existed were completed in full
+                order = Order(**{"product_marked_sold": True, "sale_recorded": True, **stored_order})
+        await complete_order(order)
     
     return {"status": "success"}
 
+async def complete_order(order: Order):
+    """Mark the product sold and count the sale, each step flagged on the order once done"""
+    async def mark_product_sold():
+        if order.product_marked_sold:
+            return
+        sold_update = {"is_available": False, "sold_at": order.created_at}
+        # Only an available product is updated, so the change hooks run once per sale
+        previous_product = await db.products.find_one_and_update(
+            {"id": order.product_id, "is_available": {"$ne": False}},
+            {"$set": sold_update, "$inc": {"version": 1}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if previous_product:
+            sold_product = {**previous_product, **sold_update, "version": previous_product.get("version", 0) + 1}
+            notify_product_change(previous_product, sold_product)
+        await db.orders.update_one({"id": order.id}, {"$set": {"product_marked_sold": True}})
+    
+    async def count_sale():
+        if order.sale_recorded:
+            return
+        # A failure between the two writes counts the sale again on redelivery; the reconciliation repairs it
+        await record_sale(order)
+        await db.orders.update_one({"id": order.id}, {"$set": {"sale_recorded": True}})
+    
+    await asyncio.gather(mark_product_sold(), count_sale())
+
 @api_router.post("/init-sample-data")
 async def init_sample_data():
     """Initialize the database with sample gaming products"""
@@ -1122,10 +4178,14 @@ async def init_sample_data():
     for review in sample_reviews:
         await db.reviews.insert_one(review.dict())
     
+    # The catalog was replaced wholesale, bypassing the product hooks
+    await game_counters.reconcile()
+    
     return {"message": "Sample data initialized successfully", "products": len(sample_products), "users": len(sample_users), "reviews": len(sample_reviews)}
 
 # Include the router in the main app
 app.include_router(api_router)
+app.add_middleware(CancelOnDisconnectMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -1142,10 +4202,54 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_background_jobs():
+    for hook in startup_hooks:
+        try:
+            await hook()
+        except Exception as e:
+            logger.error(f"❌ Erreur d'initialisation {hook.__name__}: {e}")
+    for job in background_jobs:
+        background_tasks.append(asyncio.create_task(job()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    for flush in shutdown_flushes:
+        try:
+            await flush()
+        except Exception as e:
+            logger.error(f"❌ Erreur lors du vidage final: {e}")
     client.close()
 
-# Run with: python -m uvicorn server:app --host 0.0.0.0 --port 8000 --reload
+def run_server():
+    """Production entry point: multi-worker uvicorn on uvloop/httptools, configured from the environment.
+
+    On SIGTERM uvicorn stops accepting connections and lets in-flight requests finish
+    for up to UVICORN_GRACEFUL_SHUTDOWN_SECONDS before the shutdown hooks flush
+    the background writers and close the Mongo client.
+    """
+    reload = os.environ.get('UVICORN_RELOAD', '').lower() in ('1', 'true', 'yes')
+    uvicorn.run(
+        "server:app",
+        host=os.environ.get('HOST', '0.0.0.0'),
+        port=int(os.environ.get('PORT', '8000')),
+        reload=reload,
+        # Workers cannot be combined with the reloader
+        workers=None if reload else int(os.environ.get('WEB_CONCURRENCY', str(os.cpu_count() or 1))),
+        loop="uvloop",
+        http="httptools",
+        backlog=int(os.environ.get('UVICORN_BACKLOG', '2048')),
+        timeout_keep_alive=int(os.environ.get('UVICORN_KEEP_ALIVE_SECONDS', '5')),
+        timeout_graceful_shutdown=int(os.environ.get('UVICORN_GRACEFUL_SHUTDOWN_SECONDS', '30')),
+        proxy_headers=True,
+        forwarded_allow_ips=os.environ.get('FORWARDED_ALLOW_IPS', '127.0.0.1'),
+        access_log=os.environ.get('UVICORN_ACCESS_LOG', '').lower() in ('1', 'true', 'yes'),
+    )
+
+# Production: python server.py (WEB_CONCURRENCY workers); development: UVICORN_RELOAD=1 python server.py
+# or python -m uvicorn server:app --host 0.0.0.0 --port 8000 --reload
 if __name__ == "__main__":
-    uvicorn.run("server:app", host="0.0.0.0", port=8000, reload=True)
+    run_server()
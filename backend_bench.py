@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+CocMarket Gaming Marketplace Backend Load Benchmark
+Drives concurrent scenario mixes (browse, search, product detail, login, checkout)
+against the API and reports throughput and latency percentiles per endpoint.
+
+Usage:
+    python backend_bench.py --target asgi                      # app in-process, no network
+    python backend_bench.py --seed-sample-data                 # empty database: load the sample catalog first (destructive)
+    python backend_bench.py --target http://localhost:8000     # running server
+    python backend_bench.py --stages 10:15,50:15,100:15 --mix browse=50,search=20,detail=20,login=5,checkout=5 \
+        --output bench_results.json
+    python backend_bench.py --catalog-engines mongo,columnar --mix browse=100   # compare listing engines
+
+Results are written as JSON (one entry per stage and endpoint) together with the
+git commit, so runs can be compared across commits.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import aiohttp
+
+ROOT_DIR = Path(__file__).parent
+
+DEFAULT_MIX = "browse=50,search=20,detail=20,login=5,checkout=5"
+DEFAULT_STAGES = "10:15,50:15,100:15"
+BENCH_PASSWORD = "BenchPassword123!"
+SEARCH_TERMS = ["Fortnite", "compte", "skin", "Légendaire", "Diamond", "V-Bucks", "rare", "WoW"]
+CATEGORIES = ["accounts", "items", "characters", "skins", "currency", "boosting"]
+LOCATIONS = ["fr", "eu", "na", "asia", "other"]
+
+
+class ASGIClient:
+    """Minimal in-process HTTP client calling the ASGI app directly (no sockets)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, params: Optional[Dict[str, Any]] = None,
+                      json_body: Any = None) -> Tuple[int, bytes]:
+        body = json.dumps(json_body).encode() if json_body is not None else b""
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": urlencode(params or {}, doseq=True).encode(),
+            "root_path": "",
+            "headers": [
+                (b"host", b"bench"),
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+            "client": ("127.0.0.1", random.randint(1024, 65535)),
+            "server": ("bench", 80),
+        }
+        request_sent = False
+        response_done = asyncio.Event()
+        status = 500
+        chunks: List[bytes] = []
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Behave like a client that stays connected until the response is complete
+            await response_done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    response_done.set()
+
+        await self.app(scope, receive, send)
+        response_done.set()
+        return status, b"".join(chunks)
+
+    async def close(self):
+        await self.app.router.shutdown()
+
+
+class HTTPClient:
+    """aiohttp client against a running server"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+
+    async def request(self, method: str, path: str, params: Optional[Dict[str, Any]] = None,
+                      json_body: Any = None) -> Tuple[int, bytes]:
+        async with self.session.request(method, f"{self.base_url}{path}", params=params, json=json_body) as response:
+            return response.status, await response.read()
+
+    async def close(self):
+        await self.session.close()
+
+
+class GameMarketplaceLoadTester:
+    def __init__(self, client, mix: Dict[str, int], bench_users: int, seed_sample_data: bool = False):
+        self.client = client
+        self.seed_sample_data = seed_sample_data
+        self.scenarios = list(mix)
+        self.weights = [mix[name] for name in self.scenarios]
+        self.bench_users = bench_users
+        self.product_ids: List[str] = []
+        self.credentials: List[Dict[str, str]] = []
+        self.samples: List[Tuple[str, int, float]] = []
+
+    async def timed(self, label: str, method: str, path: str, **kwargs) -> Tuple[int, bytes]:
+        """Issue one request and record (endpoint, status, latency)"""
+        start = time.perf_counter()
+        try:
+            status, body = await self.client.request(method, path, **kwargs)
+        except Exception:
+            status, body = 599, b""
+        self.samples.append((label, status, time.perf_counter() - start))
+        return status, body
+
+    async def setup(self):
+        """Collect product ids and register the benchmark users"""
+        status, body = await self.client.request("GET", "/api/products", params={"limit": 100})
+        if status != 200:
+            raise RuntimeError(f"Listing products failed with HTTP {status}")
+        self.product_ids = [product["id"] for product in json.loads(body)]
+        if not self.product_ids and self.seed_sample_data:
+            # Destructive: init-sample-data replaces the products and users
+            await self.client.request("POST", "/api/init-sample-data")
+            status, body = await self.client.request("GET", "/api/products", params={"limit": 100})
+            self.product_ids = [product["id"] for product in json.loads(body)] if status == 200 else []
+        if not self.product_ids:
+            raise RuntimeError("No products available to benchmark against (pass --seed-sample-data to load the sample catalog)")
+
+        run_id = f"{int(time.time())}{random.randint(0, 9999)}"
+        for index in range(self.bench_users):
+            credentials = {"email": f"bench_{run_id}_{index}@cocmarket.fr", "password": BENCH_PASSWORD}
+            status, _ = await self.client.request("POST", "/api/auth/register", json_body={
+                "username": f"bench_{run_id}_{index}", "location": "fr", **credentials
+            })
+            if status == 200:
+                self.credentials.append(credentials)
+
+    # Scenarios
+    async def scenario_browse(self):
+        params = {"limit": 20}
+        if random.random() < 0.6:
+            params["category"] = random.choice(CATEGORIES)
+        if random.random() < 0.3:
+            params["location"] = random.choice(LOCATIONS)
+        await self.timed("GET /api/products", "GET", "/api/products", params=params)
+        if random.random() < 0.2:
+            await self.timed("GET /api/market-stats", "GET", "/api/market-stats")
+            await self.timed("GET /api/games", "GET", "/api/games")
+
+    async def scenario_search(self):
+        await self.timed("GET /api/products?search", "GET", "/api/products",
+                         params={"search": random.choice(SEARCH_TERMS), "limit": 20})
+
+    async def scenario_detail(self):
+        product_id = random.choice(self.product_ids)
+        await self.timed("GET /api/products/{product_id}", "GET", f"/api/products/{product_id}")
+        await self.timed("GET /api/products/{product_id}/reviews", "GET", f"/api/products/{product_id}/reviews")
+
+    async def scenario_login(self):
+        if not self.credentials:
+            return
+        await self.timed("POST /api/auth/login", "POST", "/api/auth/login",
+                         json_body=random.choice(self.credentials))
+
+    async def scenario_checkout(self):
+        product_id = random.choice(self.product_ids)
+        await self.timed("GET /api/products/{product_id}", "GET", f"/api/products/{product_id}")
+        await self.timed("POST /api/create-checkout-session", "POST", "/api/create-checkout-session", json_body={
+            "product_id": product_id,
+            "success_url": "http://localhost/success",
+            "cancel_url": "http://localhost/cancel",
+        })
+
+    async def worker(self, deadline: float):
+        while time.perf_counter() < deadline:
+            scenario = random.choices(self.scenarios, weights=self.weights)[0]
+            await getattr(self, f"scenario_{scenario}")()
+
+    async def run_stage(self, concurrency: int, duration: float) -> Dict[str, Any]:
+        self.samples = []
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*(self.worker(deadline) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        return {
+            "concurrency": concurrency,
+            "duration_s": round(elapsed, 2),
+            "total_requests": len(self.samples),
+            "throughput_rps": round(len(self.samples) / elapsed, 1),
+            "endpoints": summarize(self.samples, elapsed),
+        }
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: List[Tuple[str, int, float]], elapsed: float) -> Dict[str, Dict[str, Any]]:
+    by_endpoint: Dict[str, List[Tuple[int, float]]] = {}
+    for label, status, latency in samples:
+        by_endpoint.setdefault(label, []).append((status, latency))
+
+    summary = {}
+    for label, results in sorted(by_endpoint.items()):
+        latencies = sorted(latency * 1000 for _, latency in results)
+        statuses: Dict[str, int] = {}
+        for status, _ in results:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        summary[label] = {
+            "requests": len(results),
+            "throughput_rps": round(len(results) / elapsed, 1),
+            "errors": sum(1 for status, _ in results if status >= 500),
+            "status_codes": statuses,
+            "p50_ms": round(percentile(latencies, 0.50), 2),
+            "p95_ms": round(percentile(latencies, 0.95), 2),
+            "p99_ms": round(percentile(latencies, 0.99), 2),
+            "max_ms": round(latencies[-1], 2),
+        }
+    return summary
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for item in value.split(","):
+        name, weight = item.split("=")
+        if not hasattr(GameMarketplaceLoadTester, f"scenario_{name.strip()}"):
+            raise argparse.ArgumentTypeError(f"Unknown scenario: {name}")
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+def parse_stages(value: str) -> List[Tuple[int, float]]:
+    return [(int(concurrency), float(seconds)) for concurrency, seconds in
+            (stage.split(":") for stage in value.split(","))]
+
+
+def parse_engines(value: str) -> List[str]:
+    engines = [engine.strip() for engine in value.split(",")]
+    for engine in engines:
+        if engine not in ("mongo", "columnar"):
+            raise argparse.ArgumentTypeError(f"Unknown catalog engine: {engine}")
+    return engines
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+async def make_client(target: str, catalog_engines: List[str]):
+    if target != "asgi":
+        return HTTPClient(target)
+    if "columnar" in catalog_engines:
+        # Keeps the snapshot maintained; each run then picks its engine through server.CATALOG_ENGINE
+        os.environ["CATALOG_ENGINE"] = "columnar"
+    # The in-process app shares one client address space; lift the auth rate limits
+    # so the login scenario measures the endpoint instead of 429 rejections.
+    for name in ["RATE_LIMIT_LOGIN_IP", "RATE_LIMIT_LOGIN_EMAIL", "RATE_LIMIT_REGISTER_IP", "RATE_LIMIT_REGISTER_EMAIL"]:
+        os.environ.setdefault(name, "1000000/1")
+    sys.path.insert(0, str(ROOT_DIR / "backend"))
+    from server import app
+    await app.router.startup()
+    return ASGIClient(app)
+
+
+async def use_catalog_engine(engine: str):
+    """Switch the in-process app's listing engine, waiting for the columnar snapshot to be built"""
+    import server
+    server.CATALOG_ENGINE = engine
+    if engine == "columnar":
+        while not server.catalog_snapshot.ready:
+            await asyncio.sleep(0.1)
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    client = await make_client(args.target, args.catalog_engines or [])
+    try:
+        tester = GameMarketplaceLoadTester(client, args.mix, args.bench_users, args.seed_sample_data)
+        await tester.setup()
+        stages = []
+        for engine in args.catalog_engines or [None]:
+            if engine is not None:
+                print(f"🗃️  Catalog engine: {engine}")
+                await use_catalog_engine(engine)
+            for concurrency, duration in args.stages:
+                print(f"⏱️  Stage: {concurrency} concurrent clients for {duration:.0f}s")
+                stage = await tester.run_stage(concurrency, duration)
+                if engine is not None:
+                    stage["catalog_engine"] = engine
+                print_stage(stage)
+                stages.append(stage)
+    finally:
+        await client.close()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "target": args.target,
+        "mix": args.mix,
+        "stages": stages,
+    }
+
+
+def print_stage(stage: Dict[str, Any]):
+    print(f"   {stage['total_requests']} requests, {stage['throughput_rps']} req/s")
+    print(f"   {'endpoint':<42} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'5xx':>6}")
+    for label, result in stage["endpoints"].items():
+        print(f"   {label:<42} {result['throughput_rps']:>8} {result['p50_ms']:>8} "
+              f"{result['p95_ms']:>8} {result['p99_ms']:>8} {result['errors']:>6}")
+    print()
+
+
+def main():
+    """Main benchmark execution"""
+    parser = argparse.ArgumentParser(description="CocMarket backend load benchmark")
+    parser.add_argument("--target", default="asgi", help='"asgi" for in-process, or a base URL such as http://localhost:8000')
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help="scenario weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--stages", type=parse_stages, default=parse_stages(DEFAULT_STAGES), help="concurrency:seconds ramp, e.g. " + DEFAULT_STAGES)
+    parser.add_argument("--bench-users", type=int, default=5, help="users registered for the login scenario")
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    parser.add_argument("--seed-sample-data", action="store_true",
+                        help="load the sample catalog when the target has no products (wipes products and users)")
+    parser.add_argument("--catalog-engines", type=parse_engines,
+                        help="run the stages once per product listing engine (asgi target only), e.g. mongo,columnar")
+    args = parser.parse_args()
+    if args.catalog_engines and args.target != "asgi":
+        parser.error("--catalog-engines needs --target asgi")
+
+    print("🚀 Starting CocMarket Gaming Marketplace Load Benchmark")
+    print("=" * 60)
+    results = asyncio.run(run_benchmark(args))
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+        print(f"📄 Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ Tests all gaming marketplace endpoints with realistic French gaming data
 import requests
 import json
 import sys
+import time
 from datetime import datetime
 from typing import Dict, List, Any
 
@@ -58,6 +59,26 @@ class GameMarketplaceAPITester:
             self.log_test("API Health Check", False, f"Connection error: {str(e)}")
             return False
     
+    def test_metrics_endpoint(self):
+        """Test Prometheus metrics exposition"""
+        try:
+            self.session.get(f"{self.base_url}/categories")
+            response = self.session.get(f"{self.base_url}/metrics")
+            if response.status_code == 200:
+                text = response.text
+                if "http_request_duration_seconds_bucket" in text and 'route="/api/categories"' in text:
+                    self.log_test("Metrics Endpoint", True, f"Exposed {len(text.splitlines())} metric lines")
+                    return True
+                else:
+                    self.log_test("Metrics Endpoint", False, "Route latency histogram missing", text[:500])
+                    return False
+            else:
+                self.log_test("Metrics Endpoint", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("Metrics Endpoint", False, f"Error: {str(e)}")
+            return False
+    
     def test_init_sample_data(self):
         """Test sample data initialization"""
         try:
@@ -144,6 +165,38 @@ class GameMarketplaceAPITester:
         
         return all_passed
     
+    def test_product_facets(self):
+        """Test facet counts returned alongside filtered products"""
+        try:
+            response = self.session.get(f"{self.base_url}/products",
+                                        params={"location": "fr", "include_facets": True})
+            if response.status_code == 200:
+                data = response.json()
+                if "products" in data and "facets" in data:
+                    facets = data["facets"]
+                    missing = [f for f in ["category", "location", "condition", "price"] if f not in facets]
+                    category_total = sum(item["count"] for item in facets.get("category", []))
+                    price_total = sum(item["count"] for item in facets.get("price", []))
+                    if missing:
+                        self.log_test("Product Facets", False, f"Missing facets: {missing}")
+                        return False
+                    if category_total != price_total:
+                        self.log_test("Product Facets", False,
+                                    f"Category and price facets disagree: {category_total} vs {price_total}")
+                        return False
+                    self.log_test("Product Facets", True,
+                                f"Facets cover {category_total} products across {len(facets['category'])} categories")
+                    return True
+                else:
+                    self.log_test("Product Facets", False, f"Unexpected response format: {data}")
+                    return False
+            else:
+                self.log_test("Product Facets", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("Product Facets", False, f"Error: {str(e)}")
+            return False
+    
     def test_get_single_product(self):
         """Test getting a single product by ID"""
         if not self.sample_product_ids:
@@ -170,6 +223,36 @@ class GameMarketplaceAPITester:
             self.log_test("Get Single Product", False, f"Error: {str(e)}")
             return False
     
+    def test_similar_products(self):
+        """Test the similar listings rail of a product"""
+        if not self.sample_product_ids:
+            self.log_test("Similar Products", False, "No product IDs available for testing")
+            return False
+        
+        try:
+            product_id = self.sample_product_ids[0]
+            response = self.session.get(f"{self.base_url}/products/{product_id}/similar", params={"limit": 5})
+            if response.status_code == 200:
+                similar = response.json()
+                if not isinstance(similar, list) or len(similar) > 5:
+                    self.log_test("Similar Products", False, f"Unexpected response: {similar}")
+                    return False
+                if any(item["id"] == product_id for item in similar):
+                    self.log_test("Similar Products", False, "Product is listed as similar to itself")
+                    return False
+                scores = [item["score"] for item in similar]
+                if scores != sorted(scores, reverse=True):
+                    self.log_test("Similar Products", False, f"Scores not sorted: {scores}")
+                    return False
+                self.log_test("Similar Products", True, f"Got {len(similar)} similar listings")
+                return True
+            else:
+                self.log_test("Similar Products", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("Similar Products", False, f"Error: {str(e)}")
+            return False
+    
     def test_create_product(self):
         """Test creating a new gaming product"""
         new_product = {
@@ -234,6 +317,53 @@ class GameMarketplaceAPITester:
             self.log_test("Get Categories", False, f"Error: {str(e)}")
             return False
     
+    def test_autocomplete(self):
+        """Test typeahead suggestions for the search box"""
+        try:
+            response = self.session.get(f"{self.base_url}/autocomplete", params={"q": "cla"})
+            if response.status_code == 200:
+                suggestions = response.json()
+                unexpected = [s["text"] for s in suggestions if not s["text"].lower().startswith("cla")]
+                if unexpected:
+                    self.log_test("Autocomplete", False, f"Suggestions not matching the prefix: {unexpected}")
+                    return False
+                counts = [s["count"] for s in suggestions]
+                if counts != sorted(counts, reverse=True):
+                    self.log_test("Autocomplete", False, f"Suggestions not ranked by listing count: {counts}")
+                    return False
+                self.log_test("Autocomplete", True, f"Suggestions: {[s['text'] for s in suggestions]}")
+                return True
+            else:
+                self.log_test("Autocomplete", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("Autocomplete", False, f"Error: {str(e)}")
+            return False
+    
+    def test_conditional_get(self):
+        """Test ETag revalidation on public read endpoints"""
+        all_passed = True
+        for path in ["/categories", "/games", "/market-stats"]:
+            test_name = f"Conditional GET {path}"
+            try:
+                first = self.session.get(f"{self.base_url}{path}")
+                etag = first.headers.get("ETag")
+                if first.status_code != 200 or not etag or "Cache-Control" not in first.headers:
+                    self.log_test(test_name, False, f"HTTP {first.status_code}, headers: {dict(first.headers)}")
+                    all_passed = False
+                    continue
+                second = self.session.get(f"{self.base_url}{path}", headers={"If-None-Match": etag})
+                if second.status_code == 304 and not second.content:
+                    self.log_test(test_name, True, f"Revalidated with ETag {etag}")
+                else:
+                    self.log_test(test_name, False, f"Expected 304, got HTTP {second.status_code}")
+                    all_passed = False
+            except Exception as e:
+                self.log_test(test_name, False, f"Error: {str(e)}")
+                all_passed = False
+        
+        return all_passed
+    
     def test_popular_games(self):
         """Test getting popular games"""
         try:
@@ -307,6 +437,39 @@ class GameMarketplaceAPITester:
             self.log_test("Product Reviews", False, f"Error: {str(e)}")
             return False
     
+    def test_price_insight(self):
+        """Test the fair-price insight of a product and the per-game price distribution"""
+        if not self.sample_product_ids:
+            self.log_test("Price Insight", False, "No product IDs available for testing")
+            return False
+        
+        try:
+            product_id = self.sample_product_ids[0]
+            response = self.session.get(f"{self.base_url}/products/{product_id}/price-insight")
+            if response.status_code != 200:
+                self.log_test("Price Insight", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            insight = response.json()
+            if insight.get("verdict") not in ["low", "fair", "high", "insufficient_data"]:
+                self.log_test("Price Insight", False, f"Unexpected verdict: {insight}")
+                return False
+            
+            group = insight.get("group")
+            if group:
+                response = self.session.get(f"{self.base_url}/games/{group['game_name']}/price-distribution")
+                if response.status_code != 200:
+                    self.log_test("Price Insight", False, f"Distribution HTTP {response.status_code}: {response.text}")
+                    return False
+                for stats in response.json():
+                    if not stats["min"] <= stats["p25"] <= stats["median"] <= stats["p75"] <= stats["max"]:
+                        self.log_test("Price Insight", False, f"Percentiles out of order: {stats}")
+                        return False
+            self.log_test("Price Insight", True, f"Verdict: {insight['verdict']}, percentile rank: {insight.get('percentile_rank')}")
+            return True
+        except Exception as e:
+            self.log_test("Price Insight", False, f"Error: {str(e)}")
+            return False
+    
     def test_market_stats(self):
         """Test market statistics endpoint"""
         try:
@@ -698,6 +861,106 @@ class GameMarketplaceAPITester:
             self.log_test("Get Current User", False, f"Error: {str(e)}")
             return False
     
+    def test_presence_heartbeat(self):
+        """Test that a heartbeat marks the user online in their seller profile"""
+        if not self.auth_tokens:
+            self.log_test("Presence Heartbeat", False, "No auth tokens available for testing")
+            return False
+        
+        try:
+            token = self.auth_tokens[-1]
+            response = self.session.post(f"{self.base_url}/presence/heartbeat", params={"token": token})
+            if response.status_code != 200:
+                self.log_test("Presence Heartbeat", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            
+            user = self.session.get(f"{self.base_url}/auth/me", params={"token": token}).json()
+            response = self.session.get(f"{self.base_url}/sellers/{user['id']}/profile")
+            seller = response.json()["seller"]
+            if seller["is_online"] and seller["last_seen"] and seller["password_hash"] == "***":
+                self.log_test("Presence Heartbeat", True, f"User online, last seen {seller['last_seen']}")
+                return True
+            else:
+                self.log_test("Presence Heartbeat", False, f"Unexpected seller presence: {seller}")
+                return False
+        except Exception as e:
+            self.log_test("Presence Heartbeat", False, f"Error: {str(e)}")
+            return False
+    
+    def test_favorites(self):
+        """Test favoriting, listing and unfavoriting a product"""
+        if not self.auth_tokens or not self.sample_product_ids:
+            self.log_test("Favorites", False, "No auth tokens or product IDs available for testing")
+            return False
+        
+        try:
+            token = self.auth_tokens[-1]
+            product_id = self.sample_product_ids[0]
+            # Favoriting twice must not count twice
+            for _ in range(2):
+                response = self.session.post(f"{self.base_url}/products/{product_id}/favorite", params={"token": token})
+                if response.status_code != 200:
+                    self.log_test("Favorites", False, f"HTTP {response.status_code}: {response.text}")
+                    return False
+            
+            favorites = self.session.get(f"{self.base_url}/favorites", params={"token": token}).json()
+            if [p["id"] for p in favorites].count(product_id) != 1:
+                self.log_test("Favorites", False, f"Product missing or duplicated in favorites: {favorites}")
+                return False
+            
+            self.session.delete(f"{self.base_url}/products/{product_id}/favorite", params={"token": token})
+            favorites = self.session.get(f"{self.base_url}/favorites", params={"token": token}).json()
+            if any(p["id"] == product_id for p in favorites):
+                self.log_test("Favorites", False, "Product still listed after unfavoriting")
+                return False
+            self.log_test("Favorites", True, "Favorite added once, listed and removed")
+            return True
+        except Exception as e:
+            self.log_test("Favorites", False, f"Error: {str(e)}")
+            return False
+    
+    def test_saved_searches(self):
+        """Test saving a search, being notified of a matching listing and deleting the search"""
+        if not self.auth_tokens:
+            self.log_test("Saved Searches", False, "No auth tokens available for testing")
+            return False
+        
+        try:
+            token = self.auth_tokens[-1]
+            response = self.session.post(f"{self.base_url}/saved-searches", params={"token": token}, json={
+                "game_name": "Fortnite", "category": "accounts", "location": "fr", "max_price": 200
+            })
+            if response.status_code != 200:
+                self.log_test("Saved Searches", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            search_id = response.json()["id"]
+            
+            product = self.session.post(f"{self.base_url}/products", json={
+                "title": "Compte Fortnite alerte", "description": "Listing for the saved search test",
+                "category": "accounts", "game_name": "Fortnite", "price": 150, "location": "fr",
+                "seller_id": "saved-search-test-seller"
+            }).json()
+            # Notifications go through the outbox, delivered by a background job
+            deadline = time.time() + 30
+            while True:
+                notifications = self.session.get(f"{self.base_url}/notifications", params={"token": token}).json()
+                if any(n["product_id"] == product["id"] and n["saved_search_id"] == search_id for n in notifications):
+                    break
+                if time.time() > deadline:
+                    self.log_test("Saved Searches", False, f"No notification for the matching listing: {notifications}")
+                    return False
+                time.sleep(0.5)
+            
+            response = self.session.delete(f"{self.base_url}/saved-searches/{search_id}", params={"token": token})
+            if response.status_code != 200:
+                self.log_test("Saved Searches", False, f"Delete failed: HTTP {response.status_code}")
+                return False
+            self.log_test("Saved Searches", True, "Matching listing notified, search deleted")
+            return True
+        except Exception as e:
+            self.log_test("Saved Searches", False, f"Error: {str(e)}")
+            return False
+    
     def test_auth_update_profile(self):
         """Test updating user profile"""
         if not self.auth_tokens:
@@ -876,7 +1139,7 @@ class GameMarketplaceAPITester:
                 reg_data = reg_response.json()
                 first_token = reg_data["token"]
                 
-                # Login again to get a new token (should deactivate old sessions)
+                # Login again to get a new token (sessions beyond the per-user cap are removed)
                 login_response = self.session.post(f"{self.base_url}/auth/login", json={
                     "email": session_user["email"],
                     "password": session_user["password"]
@@ -952,19 +1215,29 @@ class GameMarketplaceAPITester:
         # Test sequence
         tests = [
             ("API Health Check", self.test_api_health),
+            ("Metrics Endpoint", self.test_metrics_endpoint),
             ("Sample Data Initialization", self.test_init_sample_data),
             ("Get All Products", self.test_get_products),
             ("Product Filtering", self.test_product_filtering),
+            ("Product Facets", self.test_product_facets),
             ("Get Single Product", self.test_get_single_product),
+            ("Similar Products", self.test_similar_products),
             ("Create New Product", self.test_create_product),
+            ("User Registration", self.test_auth_user_registration),
+            ("Presence Heartbeat", self.test_presence_heartbeat),
+            ("Favorites", self.test_favorites),
+            ("Saved Searches", self.test_saved_searches),
             ("Gaming Categories", self.test_categories_endpoint),
             ("Popular Games", self.test_popular_games),
+            ("Autocomplete", self.test_autocomplete),
+            ("Conditional GET", self.test_conditional_get),
             ("Enhanced User Model", self.test_enhanced_user_model),
             ("Seller Profile Endpoints", self.test_seller_profile_endpoints),
             ("Seller Stats Calculation", self.test_seller_stats_calculation),
             ("Product Reviews System", self.test_product_reviews),
             ("Market Statistics", self.test_market_stats),
             ("Price History", self.test_price_history),
+            ("Price Insight", self.test_price_insight),
             ("Error Handling", self.test_error_handling)
         ]
         
@@ -0,0 +1,152 @@
+"""Round-trip budget of the auth endpoints, measured against a recording fake database."""
+
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+from starlette.requests import Request
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class Recorder:
+    """Collects Mongo calls and counts sequential round trips (overlapping calls share one)"""
+
+    def __init__(self):
+        self.calls = []
+        self.in_flight = 0
+        self.round_trips = 0
+
+
+class RecordingCollection:
+    def __init__(self, name, recorder, results):
+        self.name = name
+        self.recorder = recorder
+        self.results = results
+
+    async def _call(self, operation):
+        recorder = self.recorder
+        recorder.calls.append((self.name, operation))
+        if recorder.in_flight == 0:
+            recorder.round_trips += 1
+        recorder.in_flight += 1
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            recorder.in_flight -= 1
+        result = self.results.get((self.name, operation))
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def insert_one(self, document):
+        result = await self._call("insert_one")
+        return result or SimpleNamespace(inserted_id=document.get("id"))
+
+    async def find_one(self, *args, **kwargs):
+        return await self._call("find_one")
+
+    async def update_many(self, *args, **kwargs):
+        return await self._call("update_many")
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._call("delete_one")
+
+
+class RecordingDatabase:
+    def __init__(self, results=None):
+        self.recorder = Recorder()
+        self.results = results or {}
+
+    def __getattr__(self, name):
+        return RecordingCollection(name, self.recorder, self.results)
+
+    __getitem__ = __getattr__
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    def install(results=None):
+        database = RecordingDatabase(results)
+        monkeypatch.setattr(server, "db", database)
+        return database
+
+    monkeypatch.setattr(server, "enforce_rate_limit", lambda *args: None)
+    return install
+
+
+@pytest.fixture
+def deferred(monkeypatch):
+    """Capture work handed to spawn_background instead of running it"""
+    spawned = []
+
+    def spawn(coro):
+        spawned.append(coro.__qualname__)
+        coro.close()
+
+    monkeypatch.setattr(server, "spawn_background", spawn)
+    return spawned
+
+
+def make_request():
+    return Request({"type": "http", "client": ("127.0.0.1", 5000), "headers": []})
+
+
+def new_user(**overrides):
+    data = {"username": "roundtrip", "email": "roundtrip@cocmarket.fr", "password": "SecurePassword123!"}
+    data.update(overrides)
+    return server.UserCreate(**data)
+
+
+def test_register_writes_user_and_session_in_one_round_trip(fake_db, deferred):
+    database = fake_db()
+
+    response = asyncio.run(server.register_user(new_user(), make_request()))
+
+    assert response.user.password_hash == "***"
+    assert sorted(database.recorder.calls) == [("sessions", "insert_one"), ("users", "insert_one")]
+    assert database.recorder.round_trips == 1
+    assert deferred == []
+
+
+@pytest.mark.parametrize("field, detail", [
+    ("email", "Email already registered"),
+    ("username", "Username already taken"),
+])
+def test_register_duplicate_key_maps_to_400(fake_db, deferred, field, detail):
+    duplicate = DuplicateKeyError("E11000 duplicate key error", 11000, {"keyPattern": {field: 1}})
+    database = fake_db({("users", "insert_one"): duplicate})
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.register_user(new_user(), make_request()))
+
+    assert error.value.status_code == 400
+    assert error.value.detail == detail
+    assert database.recorder.round_trips == 1
+    # The session written alongside the rejected user is cleaned up off the request path
+    assert len(deferred) == 1
+
+
+def test_login_reads_user_then_writes_session(fake_db, deferred):
+    stored_user = server.User(
+        username="roundtrip",
+        email="roundtrip@cocmarket.fr",
+        password_hash=server.hash_password("SecurePassword123!"),
+        location=server.LocationRegion.FR,
+    ).dict()
+    database = fake_db({("users", "find_one"): stored_user})
+
+    login = server.UserLogin(email="roundtrip@cocmarket.fr", password="SecurePassword123!")
+    response = asyncio.run(server.login_user(login, make_request()))
+
+    assert response.token
+    assert database.recorder.calls == [("users", "find_one"), ("sessions", "insert_one")]
+    assert database.recorder.round_trips == 2
+    # Trimming old sessions is deferred rather than added to the login latency
+    assert deferred == ["trim_user_sessions"]
@@ -0,0 +1,72 @@
+"""Columnar catalog: pages hydrated from Mongo never show listings the snapshot got wrong."""
+
+import asyncio
+import json
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+def listing(number, **overrides):
+    product = {
+        "id": f"p{number}", "title": f"Compte {number}", "description": "", "category": "accounts",
+        "game_name": "Fortnite", "location": "fr", "price": 100.0 + number, "seller_id": "seller",
+        "seller_name": "seller", "is_available": True, "created_at": datetime(2026, 1, 1) + timedelta(hours=number),
+    }
+    product.update(overrides)
+    return product
+
+
+@pytest.fixture
+def snapshot(monkeypatch):
+    catalog_snapshot = server.CatalogSnapshot()
+    catalog_snapshot._load(catalog_snapshot._build([listing(number) for number in range(6)]))
+    catalog_snapshot.ready = True
+    monkeypatch.setattr(server, "catalog_snapshot", catalog_snapshot)
+    return catalog_snapshot
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    documents = {f"p{number}": listing(number) for number in range(6)}
+
+    async def get_products_by_ids(product_ids):
+        return {product_id: documents[product_id] for product_id in product_ids if product_id in documents}
+
+    monkeypatch.setattr(server, "get_products_by_ids", get_products_by_ids)
+    return documents
+
+
+def page(filters, limit=3):
+    return asyncio.run(server.list_products_from_snapshot({"is_available": True, **filters}, 0, limit, False))
+
+
+def test_sold_and_repriced_listings_are_dropped_and_the_page_refilled(snapshot, stored):
+    stored["p5"]["is_available"] = False
+    stored["p4"]["price"] = 500.0
+    del stored["p3"]
+
+    products = page({"price": {"$lte": 200}})
+
+    assert [product.id for product in products] == ["p2", "p1", "p0"]
+    assert "p5" not in snapshot.rows and "p3" not in snapshot.rows
+    assert snapshot.columns["price"][snapshot.rows["p4"]] == 500.0
+
+
+def test_relayed_product_events_reach_the_snapshot(snapshot):
+    bus = server.InvalidationBus(None)
+    bus.on_event("product_event", server.apply_relayed_product_event)
+    before, after = listing(5), listing(5, is_available=False)
+    message = json.dumps({"origin": "other-worker", "topic": "product_event", "payload": jsonable_encoder({"before": before, "after": after})})
+    assert "p5" in snapshot.rows
+
+    bus.receive(message)
+
+    assert "p5" not in snapshot.rows
@@ -0,0 +1,42 @@
+"""Slow command monitoring: explains are scheduled off the slow request's deadline."""
+
+import asyncio
+import contextvars
+import sys
+import threading
+from pathlib import Path
+
+import pymongo
+from pymongo import _csot
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+def test_slow_shape_explain_runs_without_the_request_deadline(monkeypatch):
+    monitor = server.MongoCommandMonitor(slow_ms=0)
+    budgets = []
+
+    async def explain(key, database_name, command):
+        budgets.append(_csot.remaining())
+
+    monkeypatch.setattr(monitor, "_explain", explain)
+
+    async def main():
+        await monitor.attach()
+        with pymongo.timeout(2):
+            # Driver threads run with the request's context, deadline included
+            context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(
+            monitor._record_slow, "find", "products", "cocmarket", {"find": "products", "filter": {"price": 1}}, 5.0
+        ))
+        thread.start()
+        thread.join()
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    asyncio.run(main())
+
+    assert budgets == [None]
+    assert set(monitor.slow_shapes) == {'products.find {"price": "?"}'}
@@ -0,0 +1,47 @@
+"""Autocomplete prefix index: results and lookup cost independent of the prefix position."""
+
+import random
+import string
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+def build_index(size=300_000, seed=3):
+    rng = random.Random(seed)
+    counts = {}
+    while len(counts) < size:
+        counts["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))] = rng.randint(1, 1000)
+    index = server.PrefixIndex()
+    index.load(counts, {key: key for key in counts})
+    return index
+
+
+def lookup(index, prefix, limit=8):
+    start, end = index.prefix_range(prefix)
+    return index.top(start, end, limit)
+
+
+def test_top_returns_the_most_listed_keys_for_a_prefix():
+    index = server.PrefixIndex()
+    index.load({"fortnite": 40, "fifa": 10, "fall guys": 25, "valorant": 99}, {})
+
+    assert lookup(index, "f", limit=2) == [(40, "fortnite"), (25, "fall guys")]
+    assert lookup(index, "va") == [(99, "valorant")]
+    assert lookup(index, "zz") == []
+
+
+def test_late_alphabet_prefixes_cost_the_same_as_early_ones():
+    index = build_index()
+
+    def best_ms(prefix):
+        return min(timeit.repeat(lambda: lookup(index, prefix), number=20, repeat=5)) / 20 * 1000
+
+    early, late = best_ms("ab"), best_ms("zy")
+    # Walking every key before the range used to make "zy" about 20x slower than "ab"
+    assert late < max(3 * early, 0.2), (early, late)
+    assert late < 1.0
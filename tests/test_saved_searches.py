@@ -0,0 +1,135 @@
+"""Saved search matching: the interval tree, the predicate index and the alert hook."""
+
+import math
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class CapturingOutbox:
+    def __init__(self):
+        self.documents = []
+
+    def add(self, document):
+        self.documents.append(document)
+
+
+@pytest.fixture
+def index(monkeypatch):
+    saved_search_index = server.SavedSearchIndex()
+    monkeypatch.setattr(server, "saved_search_index", saved_search_index)
+    return saved_search_index
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    capturing = CapturingOutbox()
+    monkeypatch.setattr(server, "notification_outbox", capturing)
+    return capturing
+
+
+def saved_search(search_id, user_id="buyer", **criteria):
+    return {"id": search_id, "user_id": user_id, **criteria}
+
+
+def listing(**overrides):
+    product = {
+        "id": "p1", "title": "Compte Fortnite OG", "category": "accounts", "game_name": "Fortnite",
+        "location": "fr", "price": 150.0, "seller_id": "seller", "is_available": True,
+    }
+    product.update(overrides)
+    return product
+
+
+def test_interval_tree_stab_matches_a_linear_scan():
+    rng = random.Random(7)
+    intervals = []
+    for number in range(500):
+        low = rng.choice([-math.inf, rng.uniform(0, 500)])
+        high = rng.choice([math.inf, rng.uniform(0, 1000)])
+        intervals.append((low, high, str(number)))
+    tree = server.IntervalTree(intervals)
+
+    for point in [rng.uniform(-10, 1100) for _ in range(200)] + [0.0, 250.0, 1000.0]:
+        expected = {key for low, high, key in intervals if low <= point <= high}
+        assert set(tree.stab(point)) == expected
+
+
+def test_interval_tree_bounds_are_inclusive_and_empty_intervals_ignored():
+    tree = server.IntervalTree([(10, 20, "closed"), (30, 5, "empty"), (20, 20, "point")])
+
+    assert sorted(tree.stab(20)) == ["closed", "point"]
+    assert tree.stab(10) == ["closed"]
+    assert tree.stab(25) == []
+    assert server.IntervalTree([]).stab(1) == []
+
+
+def test_match_combines_predicates_and_wildcards(index):
+    index.add(saved_search("exact", category="accounts", game_name="fortnite", location="fr", max_price=200))
+    index.add(saved_search("any-game", category="accounts", min_price=100))
+    index.add(saved_search("too-cheap", game_name="Fortnite", max_price=100))
+    index.add(saved_search("other-location", game_name="Fortnite", location="eu"))
+    index.add(saved_search("other-category", category="skins"))
+
+    matched = {search["id"] for search in index.match(listing())}
+
+    assert matched == {"exact", "any-game"}
+
+
+def test_match_game_names_ignore_case_and_accents(index):
+    index.add(saved_search("pokemon", game_name="pokemon go"))
+
+    assert [search["id"] for search in index.match(listing(game_name="Pokémon GO"))] == ["pokemon"]
+
+
+def test_removed_and_replaced_searches_stop_matching(index):
+    index.add(saved_search("s1", category="accounts", max_price=200))
+    assert index.match(listing())
+
+    index.add(saved_search("s1", category="accounts", max_price=100))
+    assert index.match(listing()) == []
+
+    index.remove("s1")
+    index.remove("s1")
+    assert index.match(listing(price=50.0)) == []
+    assert index.buckets == {}
+
+
+def test_new_listing_queues_one_notification_per_user(index, outbox):
+    index.add(saved_search("a1", user_id="alice", category="accounts"))
+    index.add(saved_search("a2", user_id="alice", game_name="Fortnite", max_price=200))
+    index.add(saved_search("b1", user_id="bob", location="fr"))
+    index.add(saved_search("own", user_id="seller", category="accounts"))
+
+    server.queue_saved_search_alerts(None, listing())
+
+    notified = sorted((document["user_id"], document["kind"]) for document in outbox.documents)
+    assert notified == [("alice", "new_listing"), ("bob", "new_listing")]
+
+
+def test_price_drop_alerts_only_searches_matching_the_new_price(index, outbox):
+    index.add(saved_search("under-200", category="accounts", max_price=200))
+    before = listing(price=250.0)
+
+    server.queue_saved_search_alerts(before, listing(price=180.0))
+    server.queue_saved_search_alerts(listing(price=180.0), listing(price=190.0))
+    server.queue_saved_search_alerts(listing(price=190.0), listing(price=180.0, is_available=False))
+
+    assert [(document["kind"], document["price"], document["previous_price"]) for document in outbox.documents] == [
+        ("price_drop", 180.0, 250.0)
+    ]
+
+
+def test_listing_available_again_counts_as_new(index, outbox):
+    index.add(saved_search("s1", category="accounts"))
+
+    server.queue_saved_search_alerts(listing(is_available=False), listing())
+    server.queue_saved_search_alerts(listing(), None)
+
+    assert [document["kind"] for document in outbox.documents] == ["new_listing"]